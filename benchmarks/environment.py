@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Runs the application offline for the benchmarks: Redis is replaced by fakeredis (pip install
+# fakeredis), TheTVDB by the synthetic fixtures, and the config file, posters and thumbnails by
+# temporary files. setUp() must be called before anything is imported from the tvshows package,
+# since importing it starts the application.
+from requests.structures import CaseInsensitiveDict
+
+import os
+import re
+import requests
+
+from . import fixtures
+
+
+class StandInRedis(object):
+    """Returns fakeredis connections, which don't support Lua scripts: the scripts registered
+    by SeriesDatabase (subscriptions) fail if they're run, the benchmarks write the
+    subscriptions directly instead.
+    """
+    def __new__(cls, *args, **kwargs):
+        import fakeredis
+
+        connection = fakeredis.FakeStrictRedis()
+        connection.register_script = lambda script: StandInRedis.unsupportedScript
+
+        return connection
+
+    @staticmethod
+    def unsupportedScript(keys=[], args=[], client=None):
+        raise NotImplementedError('Lua scripts are not supported by the Redis stand-in')
+
+
+class FakeTVDB(object):
+    """Answers the requests made to TheTVDB with the synthetic fixtures.
+
+    Series archives have episodeCounts[showId] episodes (defaultEpisodes if not set), and their
+    ETag changes with the number of episodes, so conditional requests get a 304 until it's
+    changed. Updates.php lists the shows of updatedShows.
+    """
+    routes = [
+        ('archive', re.compile(r'/series/(\d+)/all/en\.zip$')),
+        ('banners', re.compile(r'/series/(\d+)/banners\.xml$')),
+        ('poster', re.compile(r'/banners/')),
+        ('search', re.compile(r'/GetSeries\.php$')),
+        ('updates', re.compile(r'/Updates\.php$'))
+    ]
+
+    def __init__(self, defaultEpisodes, firstAired):
+        self.defaultEpisodes = defaultEpisodes
+        self.firstAired = firstAired
+        self.episodeCounts = {}
+        self.updatedShows = []
+        self.time = 1000000000
+        self.requests = 0
+        self.posterContent = fixtures.posterJPEG()
+
+    def get(self, url, headers=None, params=None, **kwargs):
+        self.requests += 1
+        headers = headers or {}
+
+        for name, pattern in FakeTVDB.routes:
+            match = pattern.search(url)
+            if match:
+                return getattr(self, name)(headers, params or {}, *match.groups())
+
+        return self.response('', status=404)
+
+    def archive(self, headers, params, showId):
+        episodeCount = self.episodeCounts.get(showId, self.defaultEpisodes)
+        etag = '"%s-%d"' % (showId, episodeCount)
+
+        if headers.get('If-None-Match') == etag:
+            return self.response('', status=304)
+
+        return self.response(fixtures.showArchive(showId, episodeCount, firstAired=self.firstAired), etag=etag)
+
+    def banners(self, headers, params, showId):
+        return self.response(fixtures.bannersXML(showId))
+
+    def poster(self, headers, params):
+        return self.response(self.posterContent)
+
+    def search(self, headers, params):
+        return self.response(fixtures.searchXML(range(1, 21)))
+
+    def updates(self, headers, params):
+        return self.response(fixtures.updatesXML(self.time, self.updatedShows if params.get('type') == 'all' else ()))
+
+    def response(self, content, status=200, etag=None):
+        response = requests.models.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict({'etag': etag} if etag else {})
+        response.encoding = 'utf-8'
+        response._content = content
+        response._content_consumed = True
+
+        return response
+
+
+# Starts the application in workDir and returns it with its SeriesDatabase and the FakeTVDB
+# answering its requests
+def setUp(workDir, defaultEpisodes, firstAired):
+    import redis
+    redis.StrictRedis = StandInRedis
+
+    configFile = os.path.join(workDir, 'config.cfg')
+    with open(configFile, 'w') as f:
+        f.write('[redis]\nhost = localhost\nport = 6379\ndb = 0\n\n'
+                '[thetvdb]\napi_key = BENCHMARK\nrequests_per_second = 0\n\n'
+                '[update]\nconcurrency = 1\n')
+
+    os.environ['TVSHOWS_CONFIG'] = configFile
+    # debug mode doesn't write the log file
+    os.environ['DEBUG'] = '1'
+
+    from tvshows import app, thumbnails
+    from tvshows.database import SeriesDatabase
+
+    app.logger.disabled = True
+
+    SeriesDatabase.postersDir = os.path.join(workDir, 'posters')
+    os.makedirs(SeriesDatabase.postersDir)
+    thumbnails.baseDir = workDir
+    thumbnails.thumbsDir = os.path.join(workDir, 'thumbs')
+    thumbnails.remoteThumbsDir = os.path.join(workDir, 'remote')
+
+    series = SeriesDatabase()
+    series.db.flushdb()
+
+    tvdb = FakeTVDB(defaultEpisodes, firstAired)
+    series.http.session.get = tvdb.get
+
+    return app, series, tvdb
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from xml.sax.saxutils import escape
+
+from PIL import Image
+
+import datetime
+import StringIO
+import zipfile
+
+
+# Builds a synthetic TheTVDB series archive (series/<id>/all/en.zip) with the given number of
+# regular episodes, split in seasons of episodesPerSeason episodes, plus a few specials.
+# Episodes air weekly from firstAired.
+def showArchive(showId, episodeCount, episodesPerSeason=24, status='Continuing', firstAired=datetime.date(1990, 1, 1)):
+    xml = StringIO.StringIO()
+    xml.write('<?xml version="1.0" encoding="UTF-8" ?>\n<Data>\n')
+    xml.write('<Series><id>%s</id><SeriesName>Synthetic Show %s</SeriesName><Status>%s</Status><Network>TVDB</Network>'
+              '<Overview>%s</Overview></Series>\n' % (showId, showId, status, escape('A long overview. ' * 20)))
+
+    for special in range(1, 4):
+        xml.write(episodeXML(0, special, firstAired))
+
+    for i in range(episodeCount):
+        season, episode = i // episodesPerSeason + 1, i % episodesPerSeason + 1
+        xml.write(episodeXML(season, episode, firstAired + datetime.timedelta(days=7 * i)))
+
+    xml.write('</Data>\n')
+
+    archive = StringIO.StringIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as f:
+        f.writestr('en.xml', xml.getvalue())
+
+    return archive.getvalue()
+
+
+def episodeXML(season, episode, airdate):
+    # real archives contain many more fields per episode than the ones we use
+    return ('<Episode><id>%d%d</id><EpisodeName>Episode %d of season %d</EpisodeName><SeasonNumber>%d</SeasonNumber>'
+            '<EpisodeNumber>%d</EpisodeNumber><FirstAired>%s</FirstAired><Overview>%s</Overview><Director>Someone</Director>'
+            '<Writer>Someone else</Writer><GuestStars>|A|B|C|</GuestStars><Rating>7.5</Rating><RatingCount>12</RatingCount>'
+            '<filename>episodes/1/1.jpg</filename></Episode>\n') % (season, episode, episode, season, season, episode,
+                                                               airdate.strftime('%Y-%m-%d'), escape('Episode summary. ' * 10))
+
+
+
+# Builds a series/<id>/banners.xml listing posterCount posters (and as many fanarts, which are
+# ignored) with various ratings
+def bannersXML(showId, posterCount=10):
+    xml = StringIO.StringIO()
+    xml.write('<?xml version="1.0" encoding="UTF-8" ?>\n<Banners>\n')
+
+    for i in range(posterCount):
+        for bannerType, path in (('poster', 'posters/%s-%d.jpg' % (showId, i + 1)), ('fanart', 'fanart/original/%s-%d.jpg' % (showId, i + 1))):
+            xml.write('<Banner><id>%d</id><BannerPath>%s</BannerPath><BannerType>%s</BannerType><BannerType2>680x1000</BannerType2>'
+                      '<Language>en</Language><Rating>%.1f</Rating><RatingCount>%d</RatingCount></Banner>\n'
+                      % (i, path, bannerType, 5 + i % 5, (i * 7) % 13))
+
+    xml.write('</Banners>\n')
+
+    return xml.getvalue()
+
+
+# Builds a GetSeries.php search response with one result per show ID
+def searchXML(showIds):
+    xml = StringIO.StringIO()
+    xml.write('<?xml version="1.0" encoding="UTF-8" ?>\n<Data>\n')
+
+    for showId in showIds:
+        xml.write('<Series><seriesid>%s</seriesid><language>en</language><SeriesName>Synthetic Show %s</SeriesName>'
+                  '<Overview>%s</Overview><FirstAired>1990-01-01</FirstAired><Network>TVDB</Network><id>%s</id></Series>\n'
+                  % (showId, showId, escape('A long overview. ' * 20), showId))
+
+    xml.write('</Data>\n')
+
+    return xml.getvalue()
+
+
+# Builds an Updates.php response: the server time and, unless empty, the updated shows
+def updatesXML(time, showIds=()):
+    xml = StringIO.StringIO()
+    xml.write('<?xml version="1.0" encoding="UTF-8" ?>\n<Items>\n<Time>%d</Time>\n' % time)
+
+    for showId in showIds:
+        xml.write('<Series>%s</Series>\n' % showId)
+
+    xml.write('</Items>\n')
+
+    return xml.getvalue()
+
+
+# Builds a JPEG poster of the size of TheTVDB posters
+def posterJPEG(width=680, height=1000):
+    image = Image.new('RGB', (width, height))
+    image.putdata([(x % 256, y % 256, (x * y) % 256) for y in range(height) for x in range(width)])
+
+    jpeg = StringIO.StringIO()
+    image.save(jpeg, 'JPEG', quality=90)
+
+    return jpeg.getvalue()
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+# Times the data and rendering hot paths of the application at several library sizes, offline
+# (see environment.py), and writes the results as JSON. The results are keyed by benchmark name
+# and parameters, and can be compared with the results of a previous run to catch regressions:
+# the exit status is 1 if a benchmark's median is more than --threshold times slower.
+#
+# Usage, from the repository root:
+#   python -m benchmarks.hotpaths [--sizes 10,100,500] [--episodes 200] [--repeat 5]
+#                                 [--output results.json] [--compare baseline.json]
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+from . import environment, fixtures
+
+# version of the results format, to be incremented when it changes
+resultsFormat = 1
+
+
+# Calls func repeat times (after setUp, which isn't timed) and returns the duration of each
+# call in seconds
+def measure(func, repeat, setUp=None):
+    timings = []
+
+    for _ in range(repeat):
+        if setUp:
+            setUp()
+
+        start = timeit.default_timer()
+        func()
+        timings.append(timeit.default_timer() - start)
+
+    return timings
+
+
+def summary(timings):
+    timings = sorted(timings)
+    middle = len(timings) // 2
+    median = timings[middle] if len(timings) % 2 else (timings[middle - 1] + timings[middle]) / 2
+
+    return {
+        'iterations': len(timings),
+        'min_ms': round(timings[0] * 1000, 4),
+        'median_ms': round(median * 1000, 4),
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 4),
+        'max_ms': round(timings[-1] * 1000, 4)
+    }
+
+
+class HotPaths(object):
+    """Benchmarks of the hot paths, run against the application returned by environment.setUp.
+
+    :param episodes: number of episodes of every show
+    :param repeat: number of timed runs of every benchmark
+    """
+    def __init__(self, app, series, tvdb, episodes, repeat):
+        self.app = app
+        self.series = series
+        self.tvdb = tvdb
+        self.episodes = episodes
+        self.repeat = repeat
+        self.results = {}
+        self.nextShowId = 1
+
+        # imported once the application is set up
+        from tvshows import customfilters, episodes, keys, thumbnails
+        from tvshows.frontend import controller
+        self.customfilters = customfilters
+        self.episodesModule = episodes
+        self.keys = keys
+        self.thumbnails = thumbnails
+        self.controller = controller
+
+    def record(self, name, params, timings):
+        key = '%s[%s]' % (name, ','.join('%s=%s' % param for param in sorted(params.items())))
+        self.results[key] = summary(timings)
+
+        print >> sys.stderr, '%-50s median %10.3f ms' % (key, self.results[key]['median_ms'])
+
+    def newShowIds(self, count):
+        showIds = [str(showId) for showId in range(self.nextShowId, self.nextShowId + count)]
+        self.nextShowId += count
+
+        return showIds
+
+    # Downloads size new shows and subscribes a new user to them, half of them being partially
+    # seen. Subscriptions are written directly since the Redis stand-in can't run Lua scripts, so
+    # subscribing and unsubscribing (addShowToUser, deleteShowFromUser) aren't benchmarked.
+    def createLibrary(self, size):
+        user = 'bench%d' % size
+        showIds = self.newShowIds(size)
+
+        self.series.addUser(user, 'benchmark')
+
+        for showId in showIds:
+            self.series.downloadShow(showId)
+
+        keys = self.keys
+
+        pipe = self.series.db.pipeline(transaction=False)
+        for order, showId in enumerate(showIds):
+            pipe.zadd(keys.user(user, 'shows'), order, showId)
+            pipe.hincrby(keys.showsRefcount(keys.showShard(showId)), showId, 1)
+            pipe.sadd(keys.show(showId, 'users'), user)
+
+            if order % 2:
+                pipe.hset(keys.user(user, 'lastseen'), showId, '00010005')
+        pipe.execute()
+
+        return user, showIds
+
+    def runAll(self, sizes):
+        self.benchDownloadShow()
+        self.benchDecodeEpisodes()
+        self.benchThumbnail()
+        self.benchPrettyDate()
+        self.benchSearchShow()
+
+        for size in sizes:
+            user, showIds = self.createLibrary(size)
+
+            self.benchGetShowInfo(user, showIds)
+            self.benchGetShowsOverview(user, showIds)
+            self.benchLatestRss(user, showIds)
+            self.benchUpdate(showIds)
+
+        return self.results
+
+    def benchDownloadShow(self):
+        params = {'episodes': self.episodes}
+        showIds = iter(self.newShowIds(self.repeat))
+
+        # first download, including the posters list, the poster and its thumbnail
+        self.record('downloadShow.initial', params, measure(lambda: self.series.downloadShow(next(showIds)), self.repeat))
+
+        showId = self.newShowIds(1)[0]
+        self.series.downloadShow(showId)
+
+        # TheTVDB answers with a 304
+        self.record('downloadShow.unchanged', params, measure(lambda: self.series.downloadShow(showId), self.repeat))
+
+        # a new episode every time: the whole archive is parsed and the differences written
+        def addEpisode():
+            self.tvdb.episodeCounts[showId] = self.tvdb.episodeCounts.get(showId, self.episodes) + 1
+
+        self.record('downloadShow.changed', params, measure(lambda: self.series.downloadShow(showId), self.repeat, setUp=addEpisode))
+
+    # decoding of the stored episodes of a show, done on every show data cache miss
+    def benchDecodeEpisodes(self):
+        showId = self.newShowIds(1)[0]
+        self.series.downloadShow(showId)
+
+        members = self.series.db.zrangebyscore(self.keys.show(showId, 'episodes'), '-inf', '+inf')
+        decodeEpisode = self.episodesModule.decodeEpisode
+
+        self.record('decodeEpisode', {'episodes': len(members)}, measure(lambda: [decodeEpisode(member) for member in members], self.repeat * 10))
+
+    def benchThumbnail(self):
+        posterFile = os.path.join(self.series.postersDir, 'benchmark.jpg')
+        with open(posterFile, 'wb') as f:
+            f.write(fixtures.posterJPEG())
+
+        mtime = self.thumbnails.posterMTime(posterFile)
+        params = {'size': '187x275'}
+
+        self.record('thumbnail.generate', params, measure(lambda: self.thumbnails.generateThumbnail(posterFile, 187, 275, mtime), self.repeat))
+        self.record('thumbnail.cached', params, measure(lambda: self.thumbnails.getThumbnail(posterFile, 187, 275), self.repeat * 10))
+
+    def benchPrettyDate(self):
+        today = datetime.date.today()
+        dates = [(today + datetime.timedelta(days=days)).strftime('%Y-%m-%d') for days in range(-500, 500, 2)]
+
+        with self.app.test_request_context('/'):
+            # loads the (anonymous) user the locale depends on
+            self.app.preprocess_request()
+
+            def formatDates():
+                for dateStr in dates:
+                    self.customfilters.prettyDate(dateStr)
+
+            timings = measure(formatDates, self.repeat)
+
+        self.record('prettyDate', {'dates': len(dates)}, [timing / len(dates) for timing in timings])
+
+    def benchSearchShow(self):
+        def clearCaches():
+            self.series.searchCache.clear()
+            self.series.db.delete('search:synthetic show')
+
+        self.record('searchShow.uncached', {'results': 20}, measure(lambda: self.series.searchShow('Synthetic Show'), self.repeat, setUp=clearCaches))
+
+    def benchGetShowInfo(self, user, showIds):
+        params = {'shows': len(showIds), 'episodes': self.episodes}
+
+        def getAll():
+            for showId in showIds:
+                self.series.getShowInfo(user, showId)
+
+        def clearCaches():
+            self.series.showCache.clear()
+            self.series.episodesCache.clear()
+
+        getAll()
+        self.record('getShowInfo', params, [timing / len(showIds) for timing in measure(getAll, self.repeat)])
+        self.record('getShowInfo.cold', params, [timing / len(showIds) for timing in measure(getAll, self.repeat, setUp=clearCaches)])
+
+        self.record('getShowInfos', params, measure(lambda: self.series.getShowInfos(user, showIds), self.repeat))
+        self.record('getShowInfos.cold', params, measure(lambda: self.series.getShowInfos(user, showIds), self.repeat, setUp=clearCaches))
+
+    def benchGetShowsOverview(self, user, showIds):
+        from flask.ext.login import login_user
+        from tvshows.user import User
+
+        with self.app.test_request_context('/'):
+            login_user(User(user))
+
+            # builds the overview entries
+            self.controller.getShowsOverview()
+
+            self.record('getShowsOverview', {'shows': len(showIds), 'episodes': self.episodes}, measure(self.controller.getShowsOverview, self.repeat))
+
+    def benchLatestRss(self, user, showIds):
+        params = {'shows': len(showIds), 'episodes': self.episodes}
+        today = datetime.date.today().strftime('%Y-%m-%d')
+        client = self.app.test_client()
+
+        with self.app.test_request_context('/'):
+            self.app.preprocess_request()
+            self.record('latestRss.build', params, measure(lambda: self.controller.buildRss(user, today), self.repeat))
+
+        etag = client.get('/rss/%s.rss' % user).headers['ETag']
+
+        self.record('latestRss.cached', params, measure(lambda: client.get('/rss/%s.rss' % user), self.repeat * 10))
+        self.record('latestRss.notModified', params, measure(lambda: client.get('/rss/%s.rss' % user, headers={'If-None-Match': etag}), self.repeat * 10))
+
+    def benchUpdate(self, showIds):
+        # every show is listed as updated, but is unchanged (304)
+        self.tvdb.updatedShows = showIds
+
+        def setUp():
+            self.series.db.set(self.keys.lastUpdate, self.tvdb.time)
+
+        self.record('update', {'shows': len(showIds)}, measure(self.series.update, self.repeat, setUp=setUp))
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+
+    for key in sorted(set(results) & set(baseline)):
+        before, after = baseline[key]['median_ms'], results[key]['median_ms']
+        ratio = after / before if before else 1.0
+
+        if ratio > threshold:
+            regressions.append(key)
+
+        print >> sys.stderr, '%-50s %10.3f ms -> %10.3f ms  %5.2fx%s' % (key, before, after, ratio, '  REGRESSION' if ratio > threshold else '')
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the hot paths of the application offline.')
+    parser.add_argument('--sizes', default='10,100,500', help='comma-separated numbers of shows in the libraries (default: 10,100,500)')
+    parser.add_argument('--episodes', type=int, default=200, help='number of episodes of every show (default: 200)')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed runs of every benchmark (default: 5)')
+    parser.add_argument('--output', help='file to write the results to (default: standard output)')
+    parser.add_argument('--compare', help='results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio of the median reported as a regression (default: 1.25)')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    # a third of the episodes of every show are still to air
+    firstAired = datetime.date.today() - datetime.timedelta(weeks=args.episodes * 2 // 3)
+
+    workDir = tempfile.mkdtemp(prefix='tvshows-benchmarks-')
+    stdout = sys.stdout
+
+    try:
+        app, series, tvdb = environment.setUp(workDir, args.episodes, firstAired)
+
+        # the application prints its progress, keep the standard output for the results
+        sys.stdout = open(os.devnull, 'w')
+
+        results = HotPaths(app, series, tvdb, args.episodes, args.repeat).runAll(sizes)
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(workDir)
+
+    output = {
+        'format': resultsFormat,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {'sizes': sizes, 'episodes': args.episodes, 'repeat': args.repeat},
+        'results': results
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        print json.dumps(output, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        if baseline.get('format') != resultsFormat:
+            print >> sys.stderr, 'Cannot compare with results of format %s' % baseline.get('format')
+            sys.exit(2)
+
+        if compare(results, baseline['results'], args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Compares the time and peak memory of the streaming en.xml ingestion used by downloadShow
+# with the previous implementation (whole archive in memory, full tree and xpath calls).
+# Each method runs in its own process so that its peak RSS can be measured.
+#
+# Usage, from the repository root: python -m benchmarks.ingest [episodes...]
+from lxml import etree
+
+import imp
+import json
+import os
+import resource
+import StringIO
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+from . import fixtures
+
+# loaded by path to avoid importing the tvshows package, which starts the application
+ingest = imp.load_source('ingest', os.path.join(os.path.dirname(__file__), '..', 'tvshows', 'ingest.py'))
+
+
+def legacyParse(filename):
+    with open(filename, 'rb') as f:
+        content = f.read()
+
+    tree = etree.parse(zipfile.ZipFile(StringIO.StringIO(content)).open('en.xml'))
+
+    tree.xpath('/Data/Series/SeriesName')[0].text
+    tree.xpath('/Data/Series/Status')[0].text
+    tree.xpath('/Data/Series/Network')
+
+    count = 0
+    for episode in tree.xpath('/Data/Episode'):
+        seasonNum = int(episode.xpath('SeasonNumber')[0].text)
+
+        if seasonNum == 0: continue
+
+        json.dumps({
+            'episode_id': '%04d%04d' % (seasonNum, int(episode.xpath('EpisodeNumber')[0].text)),
+            'title': episode.xpath('EpisodeName')[0].text,
+            'season': seasonNum,
+            'episode': int(episode.xpath('EpisodeNumber')[0].text),
+            'airdate': episode.xpath('FirstAired')[0].text
+        })
+        count += 1
+
+    return count
+
+
+def streamingParse(filename):
+    count = 0
+
+    with open(filename, 'rb') as f:
+        for kind, data in ingest.iterShowArchive(zipfile.ZipFile(f)):
+            if kind == 'episode':
+                json.dumps(data)
+                count += 1
+
+    return count
+
+
+methods = {'legacy': legacyParse, 'streaming': streamingParse}
+
+
+def runMethod(method, filename):
+    start = time.time()
+    count = methods[method](filename)
+    elapsed = time.time() - start
+
+    # ru_maxrss is in kilobytes on Linux
+    print json.dumps({'episodes': count, 'seconds': elapsed, 'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+
+def main(episodeCounts):
+    results = []
+
+    for episodeCount in episodeCounts:
+        fd, filename = tempfile.mkstemp(suffix='.zip')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(fixtures.showArchive(1, episodeCount))
+
+        try:
+            for method in sorted(methods):
+                output = subprocess.check_output([sys.executable, '-m', 'benchmarks.ingest', '--run', method, filename])
+                result = json.loads(output)
+                result.update({'method': method, 'size': episodeCount})
+                results.append(result)
+
+                print '%-10s %6d episodes: %7.3f s, peak RSS %7d kB' % (method, episodeCount, result['seconds'], result['peak_rss_kb'])
+        finally:
+            os.remove(filename)
+
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--run':
+        runMethod(sys.argv[2], sys.argv[3])
+    else:
+        main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 30000])
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import sys
+
+# importing the tvshows package opens the database, which refuses data stored with the
+# previous key layout, except for migrate-keys which rewrites it
+if sys.argv[1:2] == ['migrate-keys']:
+    os.environ['TVSHOWS_SKIP_KEY_LAYOUT_CHECK'] = '1'
+
+from tvshows.database import SeriesDatabase
+from tvshows import keys
+
+
+def migrateEpisodes(args):
+    report = SeriesDatabase().migrateEpisodes()
+
+    print 'Migrated %(episodes)d episode(s) of %(shows)d show(s) to the compact format.' % report
+
+    if report['episodes']:
+        print 'Members size: %d bytes -> %d bytes (%.0f%%)' % (report['legacy_bytes'], report['compact_bytes'], 100.0 * report['compact_bytes'] / report['legacy_bytes'])
+        print 'Decoding time: %.3f s -> %.3f s' % (report['legacy_decode_seconds'], report['compact_decode_seconds'])
+
+    print 'Redis used memory: %(used_memory_before)d bytes -> %(used_memory_after)d bytes' % report
+
+
+def migrateKeys(args):
+    report = keys.migrate(SeriesDatabase().db)
+
+    print 'Migrated %(users)d user(s), %(shows)d followed show(s) and %(apitokens)d API token(s) to the cluster key layout.' % report
+
+    if report['unfollowed']:
+        print '%(unfollowed)d show(s) followed by nobody are not listed anymore.' % report
+
+
+def checkScripts(args):
+    failures = SeriesDatabase().checkScripts()
+
+    for failure in failures:
+        print failure
+
+    if failures:
+        sys.exit(1)
+
+    print 'The subscription scripts work as expected.'
+
+
+def reconcilePosters(args):
+    defaults, customs = SeriesDatabase().reconcilePosters()
+
+    print 'Posters manifest rebuilt: %d default poster(s), %d custom poster(s).' % (defaults, customs)
+
+
+parser = argparse.ArgumentParser(description='TV Shows maintenance commands')
+subparsers = parser.add_subparsers()
+
+subparsers.add_parser('check-scripts', help='run the Lua scripts against the Redis server on throwaway keys').set_defaults(func=checkScripts)
+subparsers.add_parser('migrate-episodes', help='rewrite the stored episodes in the compact format').set_defaults(func=migrateEpisodes)
+subparsers.add_parser('migrate-keys', help='rewrite the Redis keys with the Redis Cluster compatible layout').set_defaults(func=migrateKeys)
+subparsers.add_parser('reconcile-posters', help='rebuild the posters manifest from the posters directory').set_defaults(func=reconcilePosters)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.func(args)
@@ -1,13 +1,22 @@
 # -*- coding: utf-8 -*-
-from flask import Blueprint, request, Response, abort, jsonify
+from flask import Blueprint, request, Response, abort, jsonify, make_response, g
 from functools import wraps
 
+import json
+
 from ..database import SeriesDatabase
 
 api = Blueprint('api', __name__)
 
 series = SeriesDatabase()
 
+# maximum number of episodes per show returned by /user/shows
+maxEpisodesPerShow = 100
+
+# page sizes of /user/shows
+defaultPageSize = 50
+maxPageSize = 200
+
 
 def str2bool(v):
     return v.lower() in ("yes", "true", "t", "1")
@@ -21,25 +30,71 @@ def authenticate():
     return response
 
 
+# Returns the user authenticated either by an API token ("Authorization: Token <token>" header)
+# or by HTTP Basic credentials, or None
+def authenticatedUser():
+    header = request.headers.get('Authorization', '')
+
+    if header.startswith('Token '):
+        return series.checkAPIToken(header[len('Token '):].strip())
+
+    auth = request.authorization
+    if auth and series.checkAuth(auth.username, auth.password):
+        return auth.username
+
+    return None
+
+
 def requires_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        auth = request.authorization
-        if not auth or not series.checkAuth(auth.username, auth.password):
+        g.user = authenticatedUser()
+        if not g.user:
             return authenticate()
         return f(*args, **kwargs)
     return decorated
 
 
+# Answers with a 404 unless the user follows the show. Goes above user_version_etag so that
+# a 304 is never returned for a show the user does not follow.
+def requires_user_show(f):
+    @wraps(f)
+    def decorated(showid, *args, **kwargs):
+        if not series.userHasShow(g.user, showid):
+            abort(404)
+        return f(showid, *args, **kwargs)
+    return decorated
+
+
+# Uses the version of the user's data as the ETag of the response. When the client already
+# has this version, answers with a 304 before the view loads anything.
+def user_version_etag(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        etag = str(series.getUserVersion(g.user))
+
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            response = make_response(f(*args, **kwargs))
+
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag)
+        response.headers['Vary'] = 'Authorization'
+
+        return response
+    return decorated
+
+
 @api.route('/posters/<showid>', methods=['GET'])
 @requires_auth
 def get_poster(showid):
-    if not series.userHasShow(request.authorization.username, showid):
+    if not series.userHasShow(g.user, showid):
         abort(404)
 
-    showInfo = series.getShowInfo(request.authorization.username, showid)
-
-    posters = series.getTVDBPosters(showInfo)
+    posters = series.getPosters(showid)
 
     return jsonify(posters=posters)
 
@@ -47,10 +102,10 @@ def get_poster(showid):
 @api.route('/posters/<showid>', methods=['POST'])
 @requires_auth
 def set_custom_poster(showid):
-    if not series.userHasShow(request.authorization.username, showid):
+    if not series.userHasShow(g.user, showid):
         abort(404)
 
-    statusCode = series.setCustomPoster(request.authorization.username, showid, request.form['posterURL'])
+    statusCode = series.setCustomPoster(g.user, showid, request.form['posterURL'])
 
     if statusCode == 200:
         return Response(status=204)
@@ -65,10 +120,10 @@ def set_custom_poster(showid):
 @api.route('/posters/<showid>', methods=['DELETE'])
 @requires_auth
 def delete_custom_poster(showid):
-    if not series.userHasShow(request.authorization.username, showid):
+    if not series.userHasShow(g.user, showid):
         abort(404)
 
-    if not series.deleteCustomPoster(request.authorization.username, showid):
+    if not series.deleteCustomPoster(g.user, showid):
         response = jsonify(message='There is no custom poster for showID %s' % showid)
         response.status_code = 400
         return response
@@ -83,29 +138,81 @@ def search_show(show_name):
 
 @api.route('/user/shows', methods=['GET'])
 @requires_auth
+@user_version_etag
 def get_user_shows():
     withEpisodes = str2bool(request.args.get('episodes', 'false'))
     episodeLimit = int(request.args.get('limit', '0'))
     onlyUnseen = str2bool(request.args.get('unseen', 'false'))
 
-    shows = []
-    for showid in series.getUserShowList(request.authorization.username):
-        shows.append(series.getShowInfo(request.authorization.username, showid, withEpisodes=withEpisodes, episodeLimit=episodeLimit, onlyUnseen=onlyUnseen))
+    # e.g. fields=name,poster, includes the episodes only if they're listed
+    fields = request.args.get('fields')
+    if fields is not None:
+        fields = [field for field in fields.split(',') if field]
+        withEpisodes = 'episodes' in fields
+
+    # the number of episodes per show is always capped so a large library can't produce
+    # a huge response
+    if not 0 < episodeLimit <= maxEpisodesPerShow:
+        episodeLimit = maxEpisodesPerShow
+
+    # the show list is only paginated when asked to, with the next_cursor of the previous page
+    if 'cursor' in request.args or 'count' in request.args:
+        count = request.args.get('count', str(defaultPageSize))
+
+        if not count.isdigit() or not 0 < int(count) <= maxPageSize:
+            response = jsonify(message='count must be between 1 and %d' % maxPageSize)
+            response.status_code = 400
+            return response
+
+        count = int(count)
+
+        try:
+            showIds, nextCursor = series.getUserShowPage(g.user, request.args.get('cursor') or None, count)
+        except ValueError:
+            response = jsonify(message='Invalid cursor')
+            response.status_code = 400
+            return response
+
+        shows = series.getShowInfos(g.user, showIds, withEpisodes=withEpisodes, episodeLimit=episodeLimit, onlyUnseen=onlyUnseen, fields=fields)
+
+        return jsonify(shows=shows, next_cursor=nextCursor)
+
+    shows = series.getShowInfos(g.user, series.getUserShowList(g.user), withEpisodes=withEpisodes, episodeLimit=episodeLimit, onlyUnseen=onlyUnseen, fields=fields)
 
     return jsonify(shows=shows)
 
 
+# Exports every show of the user with all its episodes, one JSON object per line. The response
+# is streamed while the shows are loaded by batches, so it starts right away and doesn't need
+# to fit in memory.
+@api.route('/user/export', methods=['GET'])
+@requires_auth
+@user_version_etag
+def export_user_shows():
+    user = g.user
+    onlyUnseen = str2bool(request.args.get('unseen', 'false'))
+
+    fields = request.args.get('fields')
+    if fields is not None:
+        fields = [field for field in fields.split(',') if field]
+
+    def generate():
+        for showInfo in series.iterShowInfos(user, withEpisodes=True, onlyUnseen=onlyUnseen, fields=fields):
+            yield json.dumps(showInfo) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
 @api.route('/user/shows/<showid>', methods=['GET'])
 @requires_auth
+@requires_user_show
+@user_version_etag
 def get_show(showid):
-    if not series.userHasShow(request.authorization.username, showid):
-        abort(404)
-
     withEpisodes = str2bool(request.args.get('episodes', 'true'))
     episodeLimit = int(request.args.get('limit', '0'))
     onlyUnseen = str2bool(request.args.get('unseen', 'false'))
 
-    showInfo = series.getShowInfo(request.authorization.username, showid, withEpisodes=withEpisodes, episodeLimit=episodeLimit, onlyUnseen=onlyUnseen)
+    showInfo = series.getShowInfo(g.user, showid, withEpisodes=withEpisodes, episodeLimit=episodeLimit, onlyUnseen=onlyUnseen)
 
     return jsonify(showInfo)
 
@@ -113,12 +220,12 @@ def get_show(showid):
 @api.route('/user/shows/<showid>', methods=['PUT'])
 @requires_auth
 def add_show(showid):
-    shouldAdd = not series.userHasShow(request.authorization.username, showid)
+    shouldAdd = not series.userHasShow(g.user, showid)
 
     if shouldAdd:
-        series.addShowToUser(request.authorization.username, showid)
+        series.addShowToUser(g.user, showid)
 
-    response = jsonify(series.getShowInfo(request.authorization.username, showid))
+    response = jsonify(series.getShowInfo(g.user, showid))
 
     response.status_code = 201 if shouldAdd else 200
 
@@ -128,7 +235,7 @@ def add_show(showid):
 @api.route('/user/shows/<showid>/last_seen', methods=['PUT'])
 @requires_auth
 def change_show(showid):
-    if not series.userHasShow(request.authorization.username, showid):
+    if not series.userHasShow(g.user, showid):
         abort(404)
 
     lastSeen = request.data
@@ -137,7 +244,7 @@ def change_show(showid):
     elif not lastSeen.isdigit():
         abort(400)
 
-    if not series.setLastSeen(request.authorization.username, showid, lastSeen):
+    if not series.setLastSeen(g.user, showid, lastSeen):
         response = jsonify(message='Invalid episode_id %s' % lastSeen)
         response.status_code = 400
         return response
@@ -148,10 +255,10 @@ def change_show(showid):
 @api.route('/user/shows/<showid>', methods=['DELETE'])
 @requires_auth
 def delete_show(showid):
-    if not series.userHasShow(request.authorization.username, showid):
+    if not series.userHasShow(g.user, showid):
         abort(404)
 
-    series.deleteShowFromUser(request.authorization.username, showid)
+    series.deleteShowFromUser(g.user, showid)
 
     return Response(status=204)
 
@@ -159,17 +266,51 @@ def delete_show(showid):
 @api.route('/user/shows_order', methods=['POST'])
 @requires_auth
 def reorder_shows():
-    if not series.userHasShows(request.authorization.username, request.form.keys()):
+    # either the full list of show IDs in their new order (shows=<id>&shows=<id>...),
+    # or show IDs mapped to their order number
+    if 'shows' in request.form:
+        ordering = request.form.getlist('shows')
+    else:
+        ordering = {}
+
+        for showId, order in request.form.iteritems():
+            if not order.isdigit():
+                response = jsonify(message='Invalid order value %s' % order)
+                response.status_code = 400
+                return response
+
+            ordering[showId] = int(order)
+
+    if not series.setShowsOrder(g.user, ordering):
         response = jsonify(message='One or more show_id is invalid')
         response.status_code = 400
         return response
 
-    for showId, order in request.form.iteritems():
-        if not order.isdigit():
-            response = jsonify(message='Invalid order value %s' % order)
-            response.status_code = 400
-            return response
+    return Response(status=204)
+
 
-        series.addShowToUser(request.authorization.username, showId, order)
+@api.route('/user/tokens', methods=['GET'])
+@requires_auth
+def get_tokens():
+    return jsonify(tokens=series.getAPITokens(g.user))
+
+
+@api.route('/user/tokens', methods=['POST'])
+@requires_auth
+def create_token():
+    token, tokenInfo = series.createAPIToken(g.user, request.form.get('name', ''))
+
+    # the token itself is only returned here, we only store its hash
+    response = jsonify(token=token, **tokenInfo)
+    response.status_code = 201
+
+    return response
+
+
+@api.route('/user/tokens/<tokenid>', methods=['DELETE'])
+@requires_auth
+def revoke_token(tokenid):
+    if not series.revokeAPIToken(g.user, tokenid):
+        abort(404)
 
     return Response(status=204)
@@ -1,28 +1,157 @@
 # -*- coding: utf-8 -*-
+from datetime import date
 from lxml import etree
 
 import ConfigParser
 import errno
 import hashlib
 import json
+import math
 import os
 import re
+import Queue
 import redis
 import requests
-import StringIO
 import sys
+import tempfile
+import threading
 import time
 import zipfile 
+import zlib
 
-from .helpers import retry
+from .lrucache import LRUCache, SingleFlight
+from .episodes import decodeEpisode, encodeEpisode, isLegacyEpisode
+from .helpers import TokenBucket, airdateKey, retry
+from .httpclient import HTTPClient
+from . import ingest
+from . import keys
+from . import metrics
+from . import scripts
+from . import thumbnails
 
 
-class SeriesDatabase:
+def _episodeHasAired(episode, today):
+    return episode['airdate'] and episode['airdate'] != '0000-00-00' and airdateKey(episode['airdate']) < today
+
+
+def _overviewEntry(showId, name, episodes, lastEpisode, today):
+    entry = {
+        'show_id': showId,
+        'name': name,
+        'unseen': None,
+        'unseen_count': 0,
+        'upcoming': None,
+        'next_airdate': None
+    }
+
+    for episode in episodes:
+        if lastEpisode and episode['episode_id'] <= lastEpisode:
+            continue
+
+        if not episode['airdate'] or episode['airdate'] == '0000-00-00':
+            continue
+
+        key = airdateKey(episode['airdate'])
+
+        if key < today:
+            entry['unseen_count'] += 1
+
+            if entry['unseen'] is None:
+                entry['unseen'] = episode
+        else:
+            if entry['upcoming'] is None:
+                entry['upcoming'] = episode
+
+            if entry['next_airdate'] is None or key < entry['next_airdate']:
+                entry['next_airdate'] = key
+
+    return entry
+
+
+# Queues on pipe one HMGET per shard of showIds, on the sharded hashes named by keyFunction
+# (see keys.py). Returns the groups to pass to _shardedValues with the pipeline's results.
+def _queueShardedHmget(pipe, keyFunction, showIds):
+    groups = keys.groupByShard(showIds)
+
+    for shard, ids in groups:
+        pipe.hmget(keyFunction(shard), ids)
+
+    return groups
+
+
+# Returns the values read by the commands queued by _queueShardedHmget, taken from the
+# results iterator, in the order of showIds
+def _shardedValues(groups, results, showIds):
+    values = {}
+    for _, ids in groups:
+        values.update(zip(ids, next(results)))
+
+    return [values[showId] for showId in showIds]
+
+
+# Returns a Redis client for address, either a unix socket path or host:port, with the
+# connection settings of the [redis] section of the config
+def _redisConnection(address, config):
+    options = {'db': config.getint('redis', 'db')}
+
+    if config.has_option('redis', 'socket_timeout'):
+        options['socket_timeout'] = config.getfloat('redis', 'socket_timeout')
+
+    if address.startswith('/'):
+        options.update(connection_class=metrics.InstrumentedUnixDomainSocketConnection, path=address)
+    else:
+        host, port = address.rsplit(':', 1)
+        options.update(connection_class=metrics.InstrumentedConnection, host=host, port=int(port))
+
+    # with a maximum size, threads wait for a free connection instead of failing
+    if config.has_option('redis', 'pool_size'):
+        pool = redis.BlockingConnectionPool(max_connections=config.getint('redis', 'pool_size'), **options)
+    else:
+        pool = redis.ConnectionPool(**options)
+
+    return redis.StrictRedis(connection_pool=pool)
+
+
+class SeriesDatabase(object):
     tvdbAPIURLFormat = 'http://thetvdb.com/api/%s'
     tvdbBannerURLFormat = 'http://thetvdb.com/banners/%s'
     tvdbBannerCacheURLFormat = 'http://thetvdb.com/banners/_cache/%s'
     postersDir = os.path.join(os.path.dirname(__file__), 'static', 'posters')
 
+    # search results cache: TTL of the Redis entries (shorter for empty results),
+    # TTL and size of the in-process LRU
+    searchCacheTTL = 24 * 3600
+    searchNegativeCacheTTL = 300
+    searchLocalCacheTTL = 600
+    searchLocalCacheSize = 1000
+
+    # in-process cache of verified API tokens
+    apiTokenCacheTTL = 60
+    apiTokenCacheSize = 1000
+
+    # TTL of the cached RSS feeds, so that the feeds nobody reads anymore are freed
+    feedCacheTTL = 7 * 24 * 3600
+
+    # number of shows whose fields, and whose whole episode lists, are kept decoded in the
+    # in-process caches
+    showCacheSize = 500
+    episodesCacheSize = 500
+
+    # delay in seconds during which the reads of a user who wrote data are sent to the primary
+    # instead of the replicas, so that the user sees the changes despite the replication lag,
+    # and number of such users remembered
+    readYourWritesDelay = 5
+    recentWritersCacheSize = 10000
+
+    # number of episode writes sent to Redis at once by downloadShow
+    ingestBatchSize = 500
+
+    # fields of the show:<id> hash returned by getShowInfo
+    showInfoFields = ('name', 'status', 'country', 'network', 'seasons', 'firstaired', 'lastaired')
+
+    # keys of the show info which require loading the show's data
+    showDataInfoFields = frozenset(['name', 'status', 'country', 'network', 'seasons', 'first_aired', 'last_aired', 'episodes'])
+
     instance = None
 
     def __new__(myClass):
@@ -31,25 +160,118 @@ class SeriesDatabase:
         return myClass.instance
 
     def __init__(self):
-        configFilename = os.path.join(os.path.dirname(__file__), 'config', 'config.cfg')
+        # __init__ is called every time the singleton is requested, only initialize it once
+        if hasattr(self, 'db'):
+            return
+
+        # the TVSHOWS_CONFIG environment variable can point to another config file
+        configFilename = os.environ.get('TVSHOWS_CONFIG') or os.path.join(os.path.dirname(__file__), 'config', 'config.cfg')
 
         if not os.path.exists(configFilename):
-            print >> sys.stderr, 'Missing config/config.cfg file, exiting.'
+            print >> sys.stderr, 'Missing %s file, exiting.' % configFilename
             sys.exit(1)
 
         config = ConfigParser.ConfigParser()
         config.read(configFilename)
 
-        self.db = redis.StrictRedis(host=config.get('redis', 'host'), port=config.getint('redis', 'port'), db=config.getint('redis', 'db'))
+        if config.has_option('redis', 'unix_socket_path'):
+            self.db = _redisConnection(config.get('redis', 'unix_socket_path'), config)
+        else:
+            self.db = _redisConnection('%s:%d' % (config.get('redis', 'host'), config.getint('redis', 'port')), config)
+
+        # read-only replicas of self.db, see __readDb
+        replicas = config.get('redis', 'replicas') if config.has_option('redis', 'replicas') else ''
+        self.replicas = [_redisConnection(address.strip(), config) for address in replicas.split(',') if address.strip()]
+        self.recentWriters = LRUCache(SeriesDatabase.recentWritersCacheSize)
         self.tvdbAPIKey = config.get('thetvdb', 'api_key')
         self.tvdbAuthenticatedURLFormat = SeriesDatabase.tvdbAPIURLFormat % ('%s/%%s' % self.tvdbAPIKey) # build a format string like 'http://thetvdb.com/api/API_KEY/%s
 
+        self.updateConcurrency = config.getint('update', 'concurrency') if config.has_option('update', 'concurrency') else 4
+        requestsPerSecond = config.getfloat('thetvdb', 'requests_per_second') if config.has_option('thetvdb', 'requests_per_second') else 2
+        self.tvdbRateLimiter = TokenBucket(requestsPerSecond)
+        # set in the threads of an update run, see __tvdbGet
+        self.rateLimited = threading.local()
+
+        httpTimeout = config.getfloat('http', 'timeout') if config.has_option('http', 'timeout') else 10
+        httpPoolSize = config.getint('http', 'pool_size') if config.has_option('http', 'pool_size') else 10
+        self.http = HTTPClient(self.db, timeout=httpTimeout, poolSize=httpPoolSize)
+
+        self.searchCache = LRUCache(SeriesDatabase.searchLocalCacheSize)
+        self.showCache = LRUCache(SeriesDatabase.showCacheSize)
+        self.episodesCache = LRUCache(SeriesDatabase.episodesCacheSize)
+        self.apiTokenCache = LRUCache(SeriesDatabase.apiTokenCacheSize)
+        self.searchFlight = SingleFlight()
+
+        metrics.registry.registerCache('shows', self.showCache)
+        metrics.registry.registerCache('episodes', self.episodesCache)
+        metrics.registry.registerCache('search', self.searchCache)
+        metrics.registry.registerCache('apitokens', self.apiTokenCache)
+
+        self.subscribeShowScript = self.db.register_script(scripts.subscribeShow)
+        self.subscribeUserScript = self.db.register_script(scripts.subscribeUser)
+        self.unsubscribeUserScript = self.db.register_script(scripts.unsubscribeUser)
+        self.unsubscribeShowScript = self.db.register_script(scripts.unsubscribeShow)
+
+        # set by manage.py migrate-keys, which opens the database before it's migrated
+        if not os.environ.get('TVSHOWS_SKIP_KEY_LAYOUT_CHECK'):
+            self.__checkKeyLayout()
+
         if not os.path.exists(SeriesDatabase.postersDir):
             os.makedirs(SeriesDatabase.postersDir)
 
-    @retry((requests.ConnectionError, etree.XMLSyntaxError), tries=4, delay=1)
+    # A database written by a version without the layout key uses the previous key layout, and
+    # has to be migrated with manage.py migrate-keys first. A new database gets the current one.
+    def __checkKeyLayout(self):
+        layout = self.db.get(keys.layout)
+
+        if layout is None and (self.db.exists(keys.postersManifest) or self.db.exists(keys.secretKey)):
+            print >> sys.stderr, 'The database uses the previous key layout, run "python manage.py migrate-keys" first.'
+            sys.exit(1)
+        elif layout is None:
+            self.db.set(keys.layout, keys.layoutVersion)
+        elif int(layout) != keys.layoutVersion:
+            print >> sys.stderr, 'Unsupported key layout %s, exiting.' % layout
+            sys.exit(1)
+
+    # Returns the IDs of the shows followed by at least one user, from the refcount hashes
+    def __allShowIds(self):
+        pipe = self.db.pipeline(transaction=False)
+        for shard in range(keys.showShards):
+            pipe.hkeys(keys.showsRefcount(shard))
+
+        return set(showId for showIds in pipe.execute() for showId in showIds)
+
+    # Search results are cached in two tiers: an in-process LRU in front of Redis keys with a TTL.
+    # Empty results are cached for a shorter time, and concurrent searches for the same query
+    # only send one request to TheTVDB.
     def searchShow(self, showName):
-        req = requests.get(SeriesDatabase.tvdbAPIURLFormat % 'GetSeries.php', params={'seriesname': showName})
+        query = ' '.join(showName.lower().split())
+
+        results = self.searchCache.get(query)
+        if results is not None:
+            return results
+
+        return self.searchFlight.do(query, self.__searchShowCached, query)
+
+    def __searchShowCached(self, query):
+        key = keys.search(query.encode('utf-8'))
+
+        cached = self.db.get(key)
+        if cached is not None:
+            results = json.loads(cached)
+            ttl = self.db.ttl(key)
+        else:
+            results = self.__searchTVDB(query)
+            ttl = SeriesDatabase.searchCacheTTL if results else SeriesDatabase.searchNegativeCacheTTL
+            self.db.setex(key, ttl, json.dumps(results))
+
+        self.searchCache.set(query, results, ttl=min(ttl, SeriesDatabase.searchLocalCacheTTL) if ttl > 0 else SeriesDatabase.searchLocalCacheTTL)
+
+        return results
+
+    @retry((requests.ConnectionError, etree.XMLSyntaxError), tries=4, delay=1)
+    def __searchTVDB(self, showName):
+        req = self.__tvdbGet(SeriesDatabase.tvdbAPIURLFormat % 'GetSeries.php', params={'seriesname': showName})
         tree = etree.fromstring(req.text.encode(req.encoding))
         results = []
         for e in tree.xpath('/Data/Series'):
@@ -64,14 +286,88 @@ class SeriesDatabase:
         return results
 
     def checkAuth(self, user, password):
-        return self.db.hget('user:%s' % user, 'password') == hashlib.sha256(password).hexdigest()
+        return self.db.hget(keys.user(user), 'password') == hashlib.sha256(password).hexdigest()
 
     def addUser(self, user, password):
-        self.db.hset('user:%s' % user, 'password', hashlib.sha256(password).hexdigest())
+        self.db.hset(keys.user(user), 'password', hashlib.sha256(password).hexdigest())
+
+    # API tokens are random strings only stored hashed: apitoken:<token hash> holds the token's
+    # user, and user:{<id>}:tokens holds the name and creation date of the user's tokens, keyed
+    # by token hash (which is used as the token ID). The token is listed in the user's tokens
+    # before it's valid, and invalidated before it's removed from them, so a valid token can
+    # always be revoked.
+    def createAPIToken(self, user, name):
+        token = os.urandom(20).encode('hex')
+        tokenId = hashlib.sha256(token).hexdigest()
+
+        tokenInfo = {
+            'id': tokenId,
+            'name': name,
+            'created': int(time.time())
+        }
+
+        pipe = self.db.pipeline(transaction=False)
+        pipe.hset(keys.user(user, 'tokens'), tokenId, json.dumps(tokenInfo))
+        pipe.set(keys.apiToken(tokenId), user)
+        pipe.execute()
+
+        return token, tokenInfo
+
+    def getAPITokens(self, user):
+        tokens = [json.loads(tokenInfo) for tokenInfo in self.db.hvals(keys.user(user, 'tokens'))]
+        tokens.sort(key=lambda tokenInfo: tokenInfo['created'])
+
+        return tokens
+
+    def revokeAPIToken(self, user, tokenId):
+        if not self.db.hexists(keys.user(user, 'tokens'), tokenId):
+            return False
+
+        self.db.delete(keys.apiToken(tokenId))
+        self.db.hdel(keys.user(user, 'tokens'), tokenId)
+        self.apiTokenCache.delete(tokenId)
+
+        return True
+
+    # Returns the user owning an API token, or None if the token is invalid. Valid tokens are
+    # cached in process for apiTokenCacheTTL seconds, which is how long a revoked token can
+    # still be used on the other processes.
+    def checkAPIToken(self, token):
+        if isinstance(token, unicode):
+            token = token.encode('utf-8')
+
+        tokenId = hashlib.sha256(token).hexdigest()
+
+        user = self.apiTokenCache.get(tokenId)
+
+        if user is None:
+            user = self.db.get(keys.apiToken(tokenId))
+
+            if user is not None:
+                self.apiTokenCache.set(tokenId, user, ttl=SeriesDatabase.apiTokenCacheTTL)
+
+        return user
+
+    # Returns the ranked poster list of a show. The list is stored in show:{<shard>}:<id>:posters
+    # when the show is downloaded or refreshed, so this doesn't need to call TheTVDB.
+    def getPosters(self, showId):
+        posters = self.db.get(keys.show(showId, 'posters'))
+
+        if posters is None:
+            # shows downloaded before the poster lists were stored
+            return self.refreshPosters(showId)
+
+        return json.loads(posters)
+
+    def refreshPosters(self, showId):
+        posters = self.getTVDBPosters({'show_id': showId})
+        self.db.set(keys.show(showId, 'posters'), json.dumps(posters))
+
+        return posters
 
     @retry((requests.ConnectionError, etree.XMLSyntaxError), tries=4, delay=1)
     def getTVDBPosters(self, showInfo):
-        req = requests.get(self.tvdbAuthenticatedURLFormat % 'series/%s/banners.xml' % showInfo['show_id'])
+        req = self.__tvdbGet(self.tvdbAuthenticatedURLFormat % 'series/%s/banners.xml' % showInfo['show_id'], conditional=True, cacheBody=True)
         tree = etree.fromstring(req.text.encode(req.encoding))
 
         posters = []
@@ -102,18 +398,31 @@ class SeriesDatabase:
 
     @retry(requests.ConnectionError, tries=4, delay=1)
     def downloadPoster(self, showInfo):
-        posters = self.getTVDBPosters(showInfo)
+        posters = self.getPosters(showInfo['show_id'])
 
         if not posters:
             return
 
-        req = requests.get(SeriesDatabase.tvdbBannerURLFormat % posters[0])
+        req = self.__tvdbGet(SeriesDatabase.tvdbBannerURLFormat % posters[0])
         if req.status_code == 200:
-            with open(self.posterFilename(showInfo['show_id']), 'wb') as f:
+            posterFile = self.posterFilename(showInfo['show_id'])
+
+            with open(posterFile, 'wb') as f:
                 f.write(req.content)
 
+            # the users following the show see its poster now
+            showId = showInfo['show_id']
+
+            pipe = self.db.pipeline(transaction=False)
+            pipe.hset(keys.showsPosters(keys.showShard(showId)), showId, 1)
+            for user in self.db.smembers(keys.show(showId, 'users')):
+                pipe.incr(keys.user(user, 'version'))
+            pipe.execute()
+
+            thumbnails.generateStandardThumbnails(posterFile)
+
     def setCustomPoster(self, user, showId, posterURL):
-        req = requests.get(SeriesDatabase.tvdbBannerURLFormat % posterURL)
+        req = self.__tvdbGet(SeriesDatabase.tvdbBannerURLFormat % posterURL)
 
         posterFile = self.posterFilename(showId, user=user)
         posterDir = os.path.dirname(posterFile)
@@ -125,9 +434,28 @@ class SeriesDatabase:
             with open(posterFile, 'wb') as f:
                 f.write(req.content)
 
+            pipe = self.db.pipeline()
+            pipe.hset(keys.user(user, 'posters'), showId, 1)
+            pipe.incr(keys.user(user, 'version'))
+            pipe.execute()
+
+            self.__userWrote(user)
+
+            thumbnails.generateStandardThumbnails(posterFile)
+
         return req.status_code
 
     def deleteCustomPoster(self, user, showId):
+        pipe = self.db.pipeline()
+        pipe.hdel(keys.user(user, 'posters'), showId)
+        pipe.incr(keys.user(user, 'version'))
+        pipe.execute()
+
+        self.__userWrote(user)
+
+        return self.__deleteCustomPosterFile(user, showId)
+
+    def __deleteCustomPosterFile(self, user, showId):
         posterFile = self.posterFilename(showId, user=user)
         posterDir = os.path.dirname(posterFile)
 
@@ -135,6 +463,7 @@ class SeriesDatabase:
             return False
 
         os.remove(posterFile)
+        thumbnails.deleteThumbnails(posterFile)
 
         try:
             os.rmdir(posterDir)
@@ -146,6 +475,44 @@ class SeriesDatabase:
 
         return True
 
+    # The posters found on disk are recorded in a manifest so that getShowInfo doesn't have
+    # to check the filesystem: the shows:{<shard>}:posters hashes for the default posters and
+    # the user:{<id>}:posters hashes for the custom ones. This rebuilds them from the posters
+    # directory. It lists the custom posters hashes with KEYS, which blocks the server (and only
+    # sees one node of a cluster), so it's only run by manage.py reconcile-posters.
+    def reconcilePosters(self):
+        defaults = []
+        customs = {}
+
+        for name in os.listdir(SeriesDatabase.postersDir):
+            path = os.path.join(SeriesDatabase.postersDir, name)
+
+            if os.path.isdir(path):
+                customs[name] = [os.path.splitext(filename)[0] for filename in os.listdir(path) if filename.endswith('.jpg')]
+            elif name.endswith('.jpg'):
+                defaults.append(os.path.splitext(name)[0])
+
+        pipe = self.db.pipeline(transaction=False)
+
+        for shard in range(keys.showShards):
+            pipe.delete(keys.showsPosters(shard))
+
+        for key in self.db.keys('user:{*}:posters'):
+            pipe.delete(key)
+
+        for shard, showIds in keys.groupByShard(defaults):
+            pipe.hmset(keys.showsPosters(shard), dict((showId, 1) for showId in showIds))
+
+        for user, showIds in customs.iteritems():
+            if showIds:
+                pipe.hmset(keys.user(user, 'posters'), dict((showId, 1) for showId in showIds))
+
+        pipe.set(keys.postersManifest, int(time.time()))
+
+        pipe.execute()
+
+        return len(defaults), sum(len(showIds) for showIds in customs.itervalues())
+
     def posterFilename(self, showId, user=None):
         filename = '%s.jpg' % showId
 
@@ -157,229 +524,934 @@ class SeriesDatabase:
     @retry((requests.ConnectionError, etree.XMLSyntaxError), tries=4, delay=1)
     def downloadShow(self, showId):
         print 'Downloading show info for ID %s' % showId
-        req = requests.get(self.tvdbAuthenticatedURLFormat % 'series/%s/all/en.zip' % showId)
 
-        zipContent = zipfile.ZipFile(StringIO.StringIO(req.content))
+        url = self.tvdbAuthenticatedURLFormat % 'series/%s/all/en.zip' % showId
 
-        tree = etree.parse(zipContent.open('en.xml'))
+        # only ask for the changes if we already have the show's data
+        if not self.db.exists(keys.show(showId)):
+            self.http.forget(url)
 
-        showName = tree.xpath('/Data/Series/SeriesName')[0].text
+        # the validators are stored once the changes are written, so that a failed refresh
+        # is downloaded again instead of getting a 304
+        req = self.__tvdbGet(url, conditional=True, deferValidators=True, stream=True)
 
-        pipe = self.db.pipeline()
+        if req.status_code == 304:
+            self.http.release(req)
+            print 'Show info for ID %s not modified' % showId
+
+            # the poster list is refreshed along with the show's data, unless it's missing
+            if not self.db.exists(keys.show(showId, 'posters')):
+                self.refreshPosters(showId)
 
-        pipe.delete('show:%s' % showId)
+            return {'added': 0, 'changed': 0, 'removed': 0, 'fields': 0}
 
-        pipe.hset('show:%s' % showId, 'name', showName)
+        # spool the archive to disk instead of keeping it in memory
+        with tempfile.TemporaryFile() as spool:
+            try:
+                for chunk in req.iter_content(chunk_size=64 * 1024):
+                    spool.write(chunk)
+            finally:
+                self.http.release(req)
 
-        showStatus = tree.xpath('/Data/Series/Status')[0].text
-        pipe.hset('show:%s' % showId, 'status', showStatus)
+            series, episodes, maxSeason, firstEpisode, lastEpisode = self.__parseShowArchive(zipfile.ZipFile(spool))
+
+        showName = series['SeriesName']
+        showStatus = series.get('Status')
+
+        showFields = {
+            'name': showName,
+            'status': showStatus,
+            'seasons': maxSeason
+        }
 
         # TheTVDB doesn't return the show's country unlike the old TVRage API.
-        #pipe.hset('show:%s' % showId, 'country', 'xxxx')
+        #showFields['country'] = 'xxxx'
+
+        if 'Network' in series:
+            showFields['network'] = series['Network']
+
+        # the date format in "started" and "ended" tags of the feed are not in a standard date format
+        # so we use the first episode of the list to get the show's first airing date
+        # (this was done before switching to TheTVDB but it works well so we kept it)
+        if firstEpisode:
+            showFields['firstaired'] = firstEpisode['airdate']
+
+            if showStatus == 'Ended':
+                showFields['lastaired'] = lastEpisode['airdate']
+
+        changes = self.__writeShowChanges(showId, showFields, episodes)
+        self.http.storeValidators(req)
 
-        network = tree.xpath('/Data/Series/Network')
-        if network:
-            pipe.hset('show:%s' % showId, 'network', network[0].text)
+        print 'Show %s: %d episode(s) added, %d changed, %d removed, %d field(s) changed' % (showId, changes['added'], changes['changed'], changes['removed'], changes['fields'])
 
-        pipe.delete('show:%s:episodes' % showId)
+        if any(changes.values()):
+            self.__refreshOverviews([(user, showId) for user in self.db.smembers(keys.show(showId, 'users'))])
 
+        self.refreshPosters(showId)
+
+        if not os.path.exists(self.posterFilename(showId)):
+            print 'Downloading poster for "%s" on TheTVDB.' % showName
+            self.downloadPoster({'show_id': showId, 'name': showName, 'first_aired': firstEpisode['airdate'] if firstEpisode else None})
+
+        return changes
+
+    # Parses a TheTVDB archive. Returns the series fields, the sorted set members of the
+    # episodes (a dict of member -> score), the last season number and the first and last episodes.
+    def __parseShowArchive(self, archive):
+        series = {}
+        episodes = {}
         maxSeason = 0
-        for episode in tree.xpath('/Data/Episode'):
-            seasonNum = int(episode.xpath('SeasonNumber')[0].text)
+        firstEpisode = None
+        lastEpisode = None
 
-            if seasonNum == 0: continue # ignore Season 0, contains special episodes
+        for kind, data in ingest.iterShowArchive(archive):
+            if kind == 'series':
+                series = data
+                continue
 
-            episodeNum = int(episode.xpath('EpisodeNumber')[0].text)
-            episodeId = '%04d%04d' % (seasonNum, episodeNum)
+            episodes[encodeEpisode(data)] = int(data['episode_id'])
 
-            if (seasonNum > maxSeason):
-                maxSeason = seasonNum
+            maxSeason = max(maxSeason, data['season'])
 
-            episodeInfo = {
-                'episode_id': episodeId,
-                'title': episode.xpath('EpisodeName')[0].text,
-                'season': seasonNum,
-                'episode': episodeNum,
-                'airdate': episode.xpath('FirstAired')[0].text
-            }
+            if firstEpisode is None or data['episode_id'] < firstEpisode['episode_id']:
+                firstEpisode = data
+            if lastEpisode is None or data['episode_id'] > lastEpisode['episode_id']:
+                lastEpisode = data
 
-            pipe.zadd('show:%s:episodes' % showId, episodeId, json.dumps(episodeInfo))
+        return series, episodes, maxSeason, firstEpisode, lastEpisode
 
-        pipe.hset('show:%s' % showId, 'seasons', maxSeason)
+    # Compares the show's hash fields and episodes with the stored ones and only writes the
+    # differences, instead of rewriting the whole show on every refresh. Returns the number
+    # of added, changed and removed episodes and of changed fields.
+    def __writeShowChanges(self, showId, showFields, episodes):
+        showKey = keys.show(showId)
+        episodesKey = keys.show(showId, 'episodes')
 
-        pipe.execute()
+        pipe = self.db.pipeline(transaction=False)
+        pipe.hgetall(showKey)
+        pipe.zrangebyscore(episodesKey, '-inf', '+inf', withscores=True)
+        storedFields, storedEpisodes = pipe.execute()
 
-        # the date format in "started" and "ended" tags of the feed are not in a standard date format
-        # so we retrieve the first episode of the list to get the show's first airing date
-        # (this was done before switching to TheTVDB but it works well so we kept it)
-        episodes = self.__getEpisodes(showId)
-        if len(episodes) > 0:
-            self.db.hset('show:%s' % showId, 'firstaired', episodes[0]['airdate'])
+        storedEpisodes = dict(storedEpisodes)
 
-            if showStatus == 'Ended':
-                self.db.hset('show:%s' % showId, 'lastaired', episodes[-1]['airdate'])
+        showFields = dict((key, unicode(value).encode('utf-8') if value is not None else 'None') for key, value in showFields.iteritems())
+        changedFields = dict((key, value) for key, value in showFields.iteritems() if storedFields.get(key) != value)
+        removedFields = [key for key in storedFields if key not in showFields]
 
-        if not os.path.exists(self.posterFilename(showId)):
-            print 'Downloading poster for "%s" on TheTVDB.' % showName
-            self.downloadPoster({'show_id': showId, 'name': showName, 'first_aired': episodes[0]['airdate'] if len(episodes) > 0 else None})
+        added = [(member, score) for member, score in episodes.iteritems() if member not in storedEpisodes]
+        removed = [member for member in storedEpisodes if member not in episodes]
+
+        # an episode is changed rather than added when an episode with the same ID is removed
+        removedScores = set(storedEpisodes[member] for member in removed)
+        changedCount = sum(1 for _, score in added if score in removedScores)
+
+        # the changes are applied in a single transaction, except for large ones (e.g. new shows)
+        # which are split in batches of ingestBatchSize commands
+        pipe = self.db.pipeline()
+        commands = 0
 
+        for member in removed:
+            pipe.zrem(episodesKey, member)
+            commands += 1
+
+            if commands % SeriesDatabase.ingestBatchSize == 0:
+                pipe.execute()
+
+        for member, score in added:
+            pipe.zadd(episodesKey, score, member)
+            commands += 1
+
+            if commands % SeriesDatabase.ingestBatchSize == 0:
+                pipe.execute()
+
+        if changedFields:
+            pipe.hmset(showKey, changedFields)
+        if removedFields:
+            pipe.hdel(showKey, *removedFields)
+        if added or removed or changedFields or removedFields:
+            pipe.hincrby(keys.showsVersions(keys.showShard(showId)), showId, 1)
+
+        pipe.execute()
+
+        return {
+            'added': len(added) - changedCount,
+            'changed': changedCount,
+            'removed': len(removed) - changedCount,
+            'fields': len(changedFields) + len(removedFields)
+        }
+
+    # The progress of an update run is journaled in Redis so that a crashed or retried run
+    # resumes where it stopped: app:{update}:target holds the TheTVDB time the run updates to,
+    # app:{update}:pending and app:{update}:done the remaining and completed show IDs.
+    # Shows that fail are moved to app:{update}:retry and are refreshed again by the next run.
     @retry((requests.ConnectionError, etree.XMLSyntaxError), tries=4, delay=1)
     def update(self):
+        self.rateLimited.active = True
+
+        try:
+            self.__update()
+        finally:
+            self.rateLimited.active = False
+
+    def __update(self):
         print "Starting update..."
-        allShows = set(self.db.hkeys('shows'))
+        allShows = self.__allShowIds()
+
+        target = self.db.get(keys.updateTarget)
+
+        if target:
+            target = int(target)
+            print 'Resuming interrupted update to time %d (%d show(s) already updated)...' % (target, self.db.scard(keys.updateDone))
+        else:
+            target = self.__startUpdateRun(allShows)
 
-        lastUpdate = int(self.db.get('app:lastupdate')) if self.db.get('app:lastupdate') else None
+        # shows removed by their last user since the run started don't need to be downloaded
+        showsToUpdate = self.db.smembers(keys.updatePending).intersection(allShows)
+
+        def journal(showId, error):
+            self.db.smove(keys.updatePending, keys.updateRetry if error else keys.updateDone, showId)
+
+        summary = self.refreshShows(showsToUpdate, progress=journal)
+
+        print 'Updated %d show(s) in %.1f seconds (%.2f shows/s), %d failure(s).' % (len(summary['updated']), summary['elapsed'], summary['throughput'], len(summary['failed']))
+
+        for showId, elapsed in summary['slowest']:
+            print ' - %s took %.1f seconds' % (showId, elapsed)
+
+        totals = dict((key, sum(changes[key] for changes in summary['changes'].values())) for key in ('added', 'changed', 'removed', 'fields'))
+        print 'Episodes: %(added)d added, %(changed)d changed, %(removed)d removed. Show fields: %(fields)d changed.' % totals
+
+        print 'HTTP: %s' % ', '.join('%s=%s' % item for item in sorted(self.http.stats().items()))
+
+        if summary['failed']:
+            print >> sys.stderr, 'Failed to update (will be retried on next run): %s' % ', '.join(sorted(summary['failed']))
+
+        pipe = self.db.pipeline()
+        pipe.set(keys.lastUpdate, target)
+        pipe.delete(keys.updateTarget, keys.updatePending, keys.updateDone)
+        pipe.execute()
+
+        print "Update done."
+
+    # Fetches the shows updated since the last run and journals them as the pending shows
+    # of a new update run. Returns the TheTVDB time of the run.
+    def __startUpdateRun(self, allShows):
+        lastUpdate = int(self.db.get(keys.lastUpdate)) if self.db.get(keys.lastUpdate) else None
 
         if lastUpdate:
             print 'Last update time: %d, fetching updated show since then...' % lastUpdate
-            req = requests.get(SeriesDatabase.tvdbAPIURLFormat % 'Updates.php', params={'type': 'all', 'time': lastUpdate})
+            req = self.__tvdbGet(SeriesDatabase.tvdbAPIURLFormat % 'Updates.php', params={'type': 'all', 'time': lastUpdate})
             tree = etree.fromstring(req.text.encode(req.encoding))
 
             updatedShows = tree.xpath('/Items/Series/text()')
             showsToUpdate = allShows.intersection(updatedShows)
 
-            lastUpdate = int(tree.xpath('/Items/Time')[0].text)
+            target = int(tree.xpath('/Items/Time')[0].text)
         else:
             print 'Last update time: NEVER, fetching current server date and updating all shows...'
-            req = requests.get(SeriesDatabase.tvdbAPIURLFormat % 'Updates.php', params={'type': 'none'})
+            req = self.__tvdbGet(SeriesDatabase.tvdbAPIURLFormat % 'Updates.php', params={'type': 'none'})
             tree = etree.fromstring(req.text.encode(req.encoding))
 
-            lastUpdate =  int(tree.xpath('/Items/Time')[0].text)
+            target = int(tree.xpath('/Items/Time')[0].text)
 
             showsToUpdate = allShows
 
-        for show in showsToUpdate:
-            time.sleep(1)
-            self.downloadShow(show)
-            print " - Updated", show
+        retries = self.db.smembers(keys.updateRetry).intersection(allShows)
+        if retries:
+            print 'Retrying %d show(s) that failed during the previous run' % len(retries)
 
-        lastUpdate = self.db.set('app:lastupdate', lastUpdate)
+        showsToUpdate = showsToUpdate.union(retries)
 
-        print "Update done."
+        pipe = self.db.pipeline()
+        pipe.delete(keys.updatePending, keys.updateDone, keys.updateRetry)
+        if showsToUpdate:
+            pipe.sadd(keys.updatePending, *showsToUpdate)
+        pipe.set(keys.updateTarget, target)
+        pipe.execute()
+
+        return target
+
+    # Downloads the given shows using a pool of updateConcurrency threads. Their requests to
+    # TheTVDB are rate limited by tvdbRateLimiter, and a failing show doesn't stop the others.
+    # If set, progress is called with the show ID and the exception (or None) after each show.
+    # Returns a summary of the run with the updated and failed shows and per-show timings.
+    def refreshShows(self, showIds, progress=None):
+        queue = Queue.Queue()
+        for showId in showIds:
+            queue.put(showId)
+
+        updated = []
+        failed = {}
+        timings = {}
+        changes = {}
+
+        def worker():
+            self.rateLimited.active = True
+
+            while True:
+                try:
+                    showId = queue.get_nowait()
+                except Queue.Empty:
+                    return
+
+                start = time.time()
+                try:
+                    changes[showId] = self.downloadShow(showId)
+                except Exception as e:
+                    failed[showId] = e
+                    print >> sys.stderr, ' - Failed to update %s: %r' % (showId, e)
+                else:
+                    updated.append(showId)
+                    print ' - Updated %s' % showId
+
+                timings[showId] = time.time() - start
+
+                if progress:
+                    progress(showId, failed.get(showId))
+
+        start = time.time()
+
+        threads = [threading.Thread(target=worker) for _ in range(max(1, min(self.updateConcurrency, queue.qsize())))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        elapsed = time.time() - start
+
+        return {
+            'updated': updated,
+            'failed': failed,
+            'timings': timings,
+            'changes': changes,
+            'slowest': sorted(timings.items(), key=lambda e: e[1], reverse=True)[:10],
+            'elapsed': elapsed,
+            'throughput': len(timings) / elapsed if elapsed > 0 else 0
+        }
 
+    # The show's users and refcount, then the user's list, are updated by Lua scripts (see
+    # scripts.py). The show is downloaded afterwards if it's new, and the subscription is
+    # rolled back if that fails.
     def addShowToUser(self, user, showId, order=None):
-        if not self.db.exists('show:%s' % showId):
-            self.downloadShow(showId)
+        showExists, added = self.__subscribe(user, showId, order)
 
-        # we want the new show to be at the top of the list when added
-        if order is None:
-            # get the first show in the list to get its order number
-            showList = self.db.zrange('user:%s:shows' % user, 0, 0, withscores=True)
+        self.__userWrote(user)
 
-            if showList:
-                # we take the first show's order number minus 1 for the new show
-                order = showList[0][1] - 1
-            else:
-                order = 0
+        if not showExists:
+            try:
+                self.downloadShow(showId)
+            except Exception:
+                if added:
+                    self.deleteShowFromUser(user, showId)
+                raise
+
+        if added:
+            self.__refreshOverviews([(user, showId)])
+
+    # Sets the order of several shows of the user at once. ordering is either a dict mapping
+    # show IDs to their order number, or the list of all the user's show IDs in their new order
+    # (a partial list would get order numbers colliding with the other shows'). The user's list
+    # is watched while the show IDs are checked, then all the scores are written by a single
+    # ZADD, so the list is either entirely reordered or not at all. Returns False if one of the
+    # shows isn't in the user's list, or if the list of show IDs isn't the user's whole list.
+    def setShowsOrder(self, user, ordering):
+        fullList = not isinstance(ordering, dict)
+
+        if fullList:
+            showIds = ordering
+            ordering = dict((showId, order) for order, showId in enumerate(showIds))
+
+            if len(ordering) != len(showIds):
+                return False
+        elif not ordering:
+            return True
+
+        key = keys.user(user, 'shows')
+
+        scores = []
+        for showId, order in ordering.iteritems():
+            scores.extend((order, showId))
+
+        with self.db.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
 
-        count = self.db.zadd('user:%s:shows' % user, order, showId)
-        if count == 1:
-            self.db.hincrby('shows', showId, 1)
+                    userShowIds = set(pipe.zrange(key, 0, -1))
 
+                    if not userShowIds.issuperset(ordering) or (fullList and len(userShowIds) != len(ordering)):
+                        return False
+
+                    if not ordering:
+                        return True
+
+                    pipe.multi()
+                    pipe.zadd(key, *scores)
+                    pipe.incr(keys.user(user, 'version'))
+                    pipe.execute()
+
+                    self.__userWrote(user)
+
+                    return True
+                except redis.WatchError:
+                    # the list was modified in the meantime, check it again
+                    continue
+
+    # The user's data for the show, then the show's users and refcount, are updated by Lua
+    # scripts (see scripts.py), the latter also deleting the show's data when no user follows
+    # it anymore. Only the files and the HTTP validators are deleted here.
     def deleteShowFromUser(self, user, showId):
-        self.db.hdel('user:%s:lastseen' % user, showId)
-        self.deleteCustomPoster(user, showId)
-        count = self.db.zrem('user:%s:shows' % user, showId)
-        if count == 1:
-            refcount = self.db.hincrby('shows', showId, -1)
-            if refcount <= 0:
-                self.db.delete('show:%s' % showId, 'show:%s:episodes' % showId)
-                self.db.hdel('shows', showId)
-
-                posterFile = self.posterFilename(showId)
-                if os.path.exists(posterFile):
-                    os.remove(posterFile)
+        _, deleted = self.__unsubscribe(user, showId)
+
+        self.__userWrote(user)
+        self.__deleteCustomPosterFile(user, showId)
+
+        if deleted:
+            self.http.forget(self.tvdbAuthenticatedURLFormat % 'series/%s/all/en.zip' % showId)
+            self.http.forget(self.tvdbAuthenticatedURLFormat % 'series/%s/banners.xml' % showId)
+
+            posterFile = self.posterFilename(showId)
+            if os.path.exists(posterFile):
+                os.remove(posterFile)
+            thumbnails.deleteThumbnails(posterFile)
+
+    # Runs the subscription scripts. Returns whether the show's data already exists and whether
+    # the show was added to the user's list.
+    def __subscribe(self, user, showId, order=None):
+        showExists = self.subscribeShowScript(
+            keys=[keys.show(showId, 'users'), keys.showsRefcount(keys.showShard(showId)), keys.show(showId)],
+            args=[user, showId])
+
+        added = self.subscribeUserScript(
+            keys=[keys.user(user, 'shows')],
+            args=[showId, '' if order is None else order])
+
+        return showExists, added
+
+    # Runs the unsubscription scripts. Returns whether the show was in the user's list and
+    # whether the show's data was deleted.
+    def __unsubscribe(self, user, showId):
+        shard = keys.showShard(showId)
+
+        removed = self.unsubscribeUserScript(
+            keys=[keys.user(user, 'shows'), keys.user(user, 'lastseen'), keys.user(user, 'overview'), keys.user(user, 'posters'),
+                  keys.user(user, 'version')],
+            args=[showId])
+
+        deleted = self.unsubscribeShowScript(
+            keys=[keys.show(showId, 'users'), keys.showsRefcount(shard), keys.showsVersions(shard), keys.showsPosters(shard),
+                  keys.show(showId), keys.show(showId, 'episodes'), keys.show(showId, 'posters')],
+            args=[user, showId])
+
+        return removed, deleted
 
     def setLastSeen(self, user, showId, episodeId):
         if episodeId:
             lastEpisode = str(episodeId).zfill(8)
 
-            if self.db.zcount('show:%s:episodes' % showId, lastEpisode, lastEpisode) != 0:
-                self.db.hset('user:%s:lastseen' % user, showId, lastEpisode)
+            if self.db.zcount(keys.show(showId, 'episodes'), lastEpisode, lastEpisode) != 0:
+                self.db.hset(keys.user(user, 'lastseen'), showId, lastEpisode)
             else:
                 return False
         else:
-            self.db.hdel('user:%s:lastseen' % user, showId)
+            self.db.hdel(keys.user(user, 'lastseen'), showId)
+
+        self.__refreshOverviews([(user, showId)])
 
         return True
 
+    # The version of a user's data is incremented every time an overview entry of the user is
+    # refreshed (subscription, last seen episode, show update), when a show is removed from the
+    # user's list, when the list is reordered and when a poster of the user's shows changes.
+    # It's used to know when a cached RSS feed is outdated, and as the ETag of the API. It's
+    # read from the server the user's data is read from afterwards (see __readDb), so the data
+    # is never older than the version it's tagged with.
+    def getUserVersion(self, user):
+        return int(self.__readDb(user).get(keys.user(user, 'version')) or 0)
+
+    # Returns the version of the user's data and the cached RSS feed of the user, a dict with
+    # the key it was generated for, its content and its generation time (empty if not cached).
+    def getUserFeed(self, user):
+        pipe = self.__readDb(user).pipeline(transaction=False)
+        pipe.get(keys.user(user, 'version'))
+        pipe.hgetall(keys.user(user, 'feed'))
+        version, feed = pipe.execute()
+
+        if feed:
+            feed['modified'] = int(feed['modified'])
+
+        return int(version or 0), feed
+
+    def setUserFeed(self, user, feed):
+        pipe = self.db.pipeline()
+        pipe.hmset(keys.user(user, 'feed'), feed)
+        pipe.expire(keys.user(user, 'feed'), SeriesDatabase.feedCacheTTL)
+        pipe.execute()
+
+    # Returns the connection the read-only queries of the user's data are sent to: the replica
+    # the user is assigned to, or the primary if there's none or if the user wrote data in the
+    # last readYourWritesDelay seconds (from this process). A user's reads always go to the
+    # same server, so the data read after the user's version (or a show's version) is at least
+    # as recent, and never gets cached or sent under a newer version than its own.
+    # Authentication and everything read before a write stay on the primary.
+    def __readDb(self, user):
+        if not self.replicas or self.recentWriters.get(user):
+            return self.db
+
+        return self.replicas[(zlib.crc32(user.encode('utf-8') if isinstance(user, unicode) else user) & 0xffffffff) % len(self.replicas)]
+
+    def __userWrote(self, *users):
+        for user in users:
+            self.recentWriters.set(user, True, SeriesDatabase.readYourWritesDelay)
+
     def userExists(self, user):
-        return self.db.exists('user:%s' % user)
+        return self.db.exists(keys.user(user))
 
     def getUserShowList(self, user):
-        return self.db.zrangebyscore('user:%s:shows' % user, '-inf', '+inf')
+        return self.__readDb(user).zrangebyscore(keys.user(user, 'shows'), '-inf', '+inf')
+
+    # Returns a page of at most count shows of the user's list, in the order of getUserShowList,
+    # and the cursor of the next page (None for the last page). A cursor is made of the score
+    # and ID of the last show of the previous page, so the following pages stay consistent when
+    # shows are added or removed in the meantime. Raises ValueError for an invalid cursor.
+    def getUserShowPage(self, user, cursor=None, count=50):
+        key = keys.user(user, 'shows')
+        db = self.__readDb(user)
+
+        if cursor is None:
+            minScore, lastShowId = '-inf', None
+        else:
+            minScore, lastShowId = cursor.split(':', 1)
+            minScore = float(minScore)
+
+            # float() also parses nan and inf, which the cursors we return never contain
+            if math.isnan(minScore) or math.isinf(minScore) or not lastShowId:
+                raise ValueError('Invalid cursor %s' % cursor)
+
+        # shows with the same score as the cursor's are sorted by ID, skip those up to its show
+        shows = []
+        start = 0
+        while len(shows) <= count:
+            batch = db.zrangebyscore(key, minScore, '+inf', start=start, num=count + 1, withscores=True)
+
+            shows.extend(show for show in batch if lastShowId is None or show[1] > minScore or show[0] > lastShowId)
+
+            if len(batch) < count + 1:
+                break
+            start += len(batch)
+
+        if len(shows) <= count:
+            return [showId for showId, _ in shows], None
+
+        showId, score = shows[count - 1]
+
+        return [showId for showId, _ in shows[:count]], '%r:%s' % (score, showId)
 
     def userHasShow(self, user, showId):
-        return self.db.zscore('user:%s:shows' % user, showId) is not None
+        return self.__readDb(user).zscore(keys.user(user, 'shows'), showId) is not None
 
     def userHasShows(self, user, showIds):
-        pipe = self.db.pipeline()
+        pipe = self.__readDb(user).pipeline(transaction=False)
         for showId in showIds:
-            pipe.zscore('user:%s:shows' % user, showId)
+            pipe.zscore(keys.user(user, 'shows'), showId)
 
         return not None in pipe.execute()
 
     def getUserConfigValue(self, user, key):
-        return self.db.hget('user:%s' % user, key)
+        return self.db.hget(keys.user(user), key)
 
     def setUserConfigValue(self, user, key, value):
         if value is not None:
-            self.db.hset('user:%s' % user, key, value)
+            self.db.hset(keys.user(user), key, value)
         else:
-            self.db.hdel('user:%s' % user, key)
+            self.db.hdel(keys.user(user), key)
 
     def getAppSecretKey(self):
-        secretKey = self.db.get('app:secretkey')
+        secretKey = self.db.get(keys.secretKey)
 
         if not secretKey:
             secretKey = os.urandom(24)
-            self.db.set('app:secretkey', secretKey)
+            self.db.set(keys.secretKey, secretKey)
 
         return secretKey
 
     def getShowInfo(self, user, showId, withEpisodes=True, episodeLimit=None, onlyUnseen=False):
-        showInfo = {
-            'show_id': showId,
-            'name': self.db.hget('show:%s' % showId, 'name'),
-            'status': self.db.hget('show:%s' % showId, 'status'),
-            'country': self.db.hget('show:%s' % showId, 'country'),
-            'network': self.db.hget('show:%s' % showId, 'network'),
-            'seasons': self.db.hget('show:%s' % showId, 'seasons'),
-            'last_seen': self.db.hget('user:%s:lastseen' % user, showId),
-            'first_aired': self.db.hget('show:%s' % showId, 'firstaired')
-        }
+        return self.getShowInfos(user, [showId], withEpisodes=withEpisodes, episodeLimit=episodeLimit, onlyUnseen=onlyUnseen)[0]
+
+    # Bulk version of getShowInfo, with at most two round trips to Redis: one pipeline for the
+    # last seen episodes, show versions and posters (one HMGET per shard), and one for the
+    # shows missing from the in-process cache. fields restricts the returned keys (show_id is
+    # always returned): the show data isn't loaded if none of its fields or episodes are
+    # requested, and the posters aren't looked up if poster isn't.
+    def getShowInfos(self, user, showIds, withEpisodes=True, episodeLimit=None, onlyUnseen=False, fields=None):
+        showIds = list(showIds)
+
+        if not showIds:
+            return []
+
+        if fields is not None:
+            fields = set(fields) | set(['show_id'])
+            withEpisodes = withEpisodes and 'episodes' in fields
+
+        withPosters = fields is None or 'poster' in fields
+        withShowData = fields is None or withEpisodes or bool(fields & SeriesDatabase.showDataInfoFields)
+
+        db = self.__readDb(user)
+
+        pipe = db.pipeline(transaction=False)
+        pipe.hmget(keys.user(user, 'lastseen'), showIds)
+        versionGroups = _queueShardedHmget(pipe, keys.showsVersions, showIds)
+        if withPosters:
+            pipe.hmget(keys.user(user, 'posters'), showIds)
+            posterGroups = _queueShardedHmget(pipe, keys.showsPosters, showIds)
+        results = iter(pipe.execute())
+
+        lastSeen = next(results)
+        versions = _shardedValues(versionGroups, results, showIds)
+        if withPosters:
+            customPosters = next(results)
+            defaultPosters = _shardedValues(posterGroups, results, showIds)
+        else:
+            customPosters, defaultPosters = [None] * len(showIds), [None] * len(showIds)
+
+        limit = episodeLimit or None
+
+        if withShowData:
+            episodeRanges = [(lastEpisode if onlyUnseen else None, limit) for lastEpisode in lastSeen] if withEpisodes else None
+            showFields, showEpisodes = self.__getShowData(showIds, versions, db, episodeRanges)
+        else:
+            showFields, showEpisodes = {}, None
+
+        shows = []
+        for i, (showId, lastEpisode, customPoster, defaultPoster) in enumerate(zip(showIds, lastSeen, customPosters, defaultPosters)):
+            showInfo = {
+                'show_id': showId.decode('utf-8'),
+                'last_seen': lastEpisode.decode('utf-8') if lastEpisode else lastEpisode
+            }
 
-        lastAired = self.db.hget('show:%s' % showId, 'lastaired')
-        if lastAired:
-            showInfo['last_aired'] = lastAired
-
-        # decode UTF-8 from db
-        for key in showInfo:
-            if key in showInfo and showInfo[key]:
-                showInfo[key] = showInfo[key].decode('utf-8')
-
-        if os.path.exists(self.posterFilename(showId, user=user)):
-            showInfo['poster'] = 'static/posters/%s/%s.jpg' % (user, showId)
-        elif os.path.exists(self.posterFilename(showId)):
-            showInfo['poster'] = 'static/posters/%s.jpg' % showId
-
-        if withEpisodes:
-            if onlyUnseen:
-                lastEpisode = self.db.hget('user:%s:lastseen' % user, showId) or '-inf'
-                lastEpisode = lastEpisode.decode('utf-8')
-                showInfo['episodes'] = self.__getEpisodes(showId, begin='(' + lastEpisode, limit=episodeLimit)
+            if withShowData:
+                showData = showFields[showId]
+
+                showInfo.update({
+                    'name': showData['name'],
+                    'status': showData['status'],
+                    'country': showData['country'],
+                    'network': showData['network'],
+                    'seasons': showData['seasons'],
+                    'first_aired': showData['firstaired']
+                })
+
+                if showData['lastaired']:
+                    showInfo['last_aired'] = showData['lastaired']
+
+                if withEpisodes:
+                    showInfo['episodes'] = showEpisodes[i]
+
+            if customPoster:
+                showInfo['poster'] = 'static/posters/%s/%s.jpg' % (user, showId)
+            elif defaultPoster:
+                showInfo['poster'] = 'static/posters/%s.jpg' % showId
+
+            if fields is not None:
+                showInfo = dict((key, value) for key, value in showInfo.iteritems() if key in fields)
+
+            shows.append(showInfo)
+
+        return shows
+
+    # Yields the show info of every show of the user, in the order of the user's list. The
+    # shows are loaded by batches of batchSize, so the memory used doesn't depend on the
+    # number of shows. The other arguments are the ones of getShowInfos.
+    def iterShowInfos(self, user, batchSize=50, **kwargs):
+        cursor = None
+
+        while True:
+            showIds, cursor = self.getUserShowPage(user, cursor, batchSize)
+
+            for showInfo in self.getShowInfos(user, showIds, **kwargs):
+                yield showInfo
+
+            if cursor is None:
+                break
+
+    # Returns {showId: fields} with the decoded show:{<shard>}:<id> hash of each show and, if
+    # episodeRanges is set, the list of the decoded episodes of each show (None otherwise).
+    # episodeRanges holds an (after, limit) tuple per show, to only get the episodes after the
+    # episode ID after and at most limit of them (None for no bound).
+    # The fields and the whole episode lists are kept in in-process LRUs keyed by the show's
+    # version (in the shows:{<shard>}:versions hashes), which is bumped every time the show's
+    # data changes, so a cached entry is never used once the show has been updated by any
+    # process. When the episode list of a show isn't cached, only the requested range is read
+    # and decoded, and it's cached if that's the whole list.
+    # The returned dicts and lists are shared with the caches and must not be modified.
+    # The versions and the data are read from db (the primary by default), the versions must
+    # have been read from the same server.
+    def __getShowData(self, showIds, versions=None, db=None, episodeRanges=None):
+        db = db or self.db
+
+        if versions is None:
+            pipe = db.pipeline(transaction=False)
+            groups = _queueShardedHmget(pipe, keys.showsVersions, showIds)
+            versions = _shardedValues(groups, iter(pipe.execute()), showIds)
+
+        showFields = {}
+        episodes = [None] * len(showIds) if episodeRanges is not None else None
+
+        pipe = db.pipeline(transaction=False)
+        misses = []
+        for i, (showId, version) in enumerate(zip(showIds, versions)):
+            if showId not in showFields:
+                showFields[showId] = self.showCache.get((showId, version))
+
+                if showFields[showId] is None:
+                    pipe.hmget(keys.show(showId), SeriesDatabase.showInfoFields)
+                    misses.append(('fields', showId, version))
+
+            if episodeRanges is None:
+                continue
+
+            after, limit = episodeRanges[i]
+            allEpisodes = self.episodesCache.get((showId, version))
+
+            if allEpisodes is not None:
+                if after:
+                    allEpisodes = [episode for episode in allEpisodes if episode['episode_id'] > after]
+
+                episodes[i] = allEpisodes[:limit]
             else:
-                showInfo['episodes'] = self.__getEpisodes(showId, limit=episodeLimit)
+                pipe.zrangebyscore(keys.show(showId, 'episodes'), '(' + after if after else '-inf', '+inf', start=0 if limit else None, num=limit)
+                misses.append(('episodes', i, version))
+
+        if misses:
+            for (kind, key, version), result in zip(misses, pipe.execute()):
+                if kind == 'fields':
+                    # decode UTF-8 from db
+                    showFields[key] = dict((field, value.decode('utf-8') if value else value) for field, value in zip(SeriesDatabase.showInfoFields, result))
+                    self.showCache.set((key, version), showFields[key])
+                else:
+                    episodes[key] = [decodeEpisode(member) for member in result]
+
+                    after, limit = episodeRanges[key]
+                    if not after and limit is None:
+                        self.episodesCache.set((showIds[key], version), episodes[key])
+
+        return showFields, episodes
+
+    # Returns the home page overview of the user: one entry per show with the next unseen
+    # episode, the number of unseen episodes and the next upcoming episode.
+    # Entries are stored in user:{<id>}:overview and kept up to date when the last seen episode,
+    # the subscriptions or the show data change. An entry only goes stale when one of its
+    # upcoming episodes airs, in which case it is recomputed on the first read of the day.
+    def getOverview(self, user):
+        db = self.__readDb(user)
+        showIds = db.zrangebyscore(keys.user(user, 'shows'), '-inf', '+inf')
+
+        if not showIds:
+            return []
+
+        today = date.today().strftime('%Y-%m-%d')
+
+        overview = {}
+        stale = []
+        for showId, entry in zip(showIds, db.hmget(keys.user(user, 'overview'), showIds)):
+            entry = json.loads(entry) if entry else None
+
+            if entry is None:
+                # show subscribed before the overview existed
+                stale.append((user, showId))
+            elif entry['next_airdate'] and entry['next_airdate'] < today:
+                stale.append((user, showId))
+            else:
+                overview[showId] = entry
+
+        for (_, showId), entry in zip(stale, self.__refreshOverviews(stale)):
+            overview[showId] = entry
 
-        return showInfo
+        return [overview[showId] for showId in showIds]
 
-    def __getEpisodes(self, showId, begin='-inf', end='+inf', limit=None):
-        limit = limit or None
-        start = 0 if limit else None
+    # Loads the first unseen aired episodes (at most limit, or all of them if limit is None)
+    # of each overview entry in its 'unseenEpisodes' key
+    def loadUnseenEpisodes(self, user, entries, limit=None):
+        entries = [entry for entry in entries if entry['unseen_count'] > 0]
+
+        if not entries:
+            return
 
-        episodes = []
+        today = date.today().strftime('%Y-%m-%d')
+
+        db = self.__readDb(user)
+
+        showIds = [entry['show_id'] for entry in entries]
+
+        pipe = db.pipeline(transaction=False)
+        pipe.hmget(keys.user(user, 'lastseen'), showIds)
+        groups = _queueShardedHmget(pipe, keys.showsVersions, showIds)
+        results = iter(pipe.execute())
+
+        lastSeen = next(results)
+        versions = _shardedValues(groups, results, showIds)
+
+        pending = []
+        for entry, lastEpisode, version in zip(entries, lastSeen, versions):
+            entry['unseenEpisodes'] = []
+            wanted = min(limit, entry['unseen_count']) if limit else entry['unseen_count']
+            pending.append((entry, version, lastEpisode, wanted))
+
+        # unseen aired episodes are usually the first ones after the last seen episode, but
+        # unaired ones can come first, so we keep reading until we have enough of them
+        while pending:
+            ranges = [(after, max(wanted - len(entry['unseenEpisodes']), 10)) for entry, _, after, wanted in pending]
+            _, episodeLists = self.__getShowData([entry['show_id'] for entry, _, _, _ in pending], [version for _, version, _, _ in pending], db, ranges)
+
+            stillPending = []
+            for (entry, version, _, wanted), (_, count), episodes in zip(pending, ranges, episodeLists):
+                for episode in episodes:
+                    if len(entry['unseenEpisodes']) < wanted and _episodeHasAired(episode, today):
+                        entry['unseenEpisodes'].append(episode)
+
+                if len(entry['unseenEpisodes']) < wanted and len(episodes) == count:
+                    stillPending.append((entry, version, episodes[-1]['episode_id'], wanted))
+
+            pending = stillPending
+
+    # Recomputes the overview entries of a list of (user, showId) tuples and returns them
+    def __refreshOverviews(self, userShows):
+        if not userShows:
+            return []
+
+        pipe = self.db.pipeline(transaction=False)
+        for user, showId in userShows:
+            pipe.hget(keys.user(user, 'lastseen'), showId)
+        lastSeen = pipe.execute()
+
+        # the episodes of each show are read once, from the earliest last seen episode of its users
+        after = {}
+        for (_, showId), lastEpisode in zip(userShows, lastSeen):
+            lastEpisode = lastEpisode or None
+
+            if showId not in after:
+                after[showId] = lastEpisode
+            elif after[showId] is not None and (lastEpisode is None or lastEpisode < after[showId]):
+                after[showId] = lastEpisode
+
+        showIds = list(after)
+        showFields, episodeLists = self.__getShowData(showIds, episodeRanges=[(after[showId], None) for showId in showIds])
+        showEpisodes = dict(zip(showIds, episodeLists))
+
+        today = date.today().strftime('%Y-%m-%d')
+
+        entries = []
+        pipe = self.db.pipeline(transaction=False)
+        for (user, showId), lastEpisode in zip(userShows, lastSeen):
+            entry = _overviewEntry(showId, showFields[showId]['name'], showEpisodes[showId], lastEpisode, today)
+            pipe.hset(keys.user(user, 'overview'), showId, json.dumps(entry))
+            entries.append(entry)
+        users = set(user for user, _ in userShows)
+        for user in users:
+            pipe.incr(keys.user(user, 'version'))
+        pipe.execute()
+
+        self.__userWrote(*users)
+
+        return entries
+
+    # Rewrites the episodes stored in the legacy JSON format in the compact format.
+    # Returns a report comparing the size and decoding time of both formats.
+    def migrateEpisodes(self):
+        report = {
+            'shows': 0,
+            'episodes': 0,
+            'legacy_bytes': 0,
+            'compact_bytes': 0,
+            'legacy_decode_seconds': 0.0,
+            'compact_decode_seconds': 0.0,
+            'used_memory_before': self.db.info()['used_memory']
+        }
 
-        for ep in self.db.zrangebyscore('show:%s:episodes' % showId, begin, end, start=start, num=limit):
-            episodes.append(json.loads(ep))
+        for showId in self.__allShowIds():
+            key = keys.show(showId, 'episodes')
 
-        return episodes
+            legacy = [(member, score) for member, score in self.db.zrangebyscore(key, '-inf', '+inf', withscores=True) if isLegacyEpisode(member)]
+
+            if not legacy:
+                continue
+
+            start = time.time()
+            decoded = [decodeEpisode(member) for member, _ in legacy]
+            report['legacy_decode_seconds'] += time.time() - start
+
+            compact = [encodeEpisode(episode) for episode in decoded]
+
+            start = time.time()
+            for member in compact:
+                decodeEpisode(member)
+            report['compact_decode_seconds'] += time.time() - start
+
+            pipe = self.db.pipeline()
+            for (member, score), newMember in zip(legacy, compact):
+                pipe.zrem(key, member)
+                pipe.zadd(key, score, newMember)
+            pipe.execute()
+
+            report['shows'] += 1
+            report['episodes'] += len(legacy)
+            report['legacy_bytes'] += sum(len(member) for member, _ in legacy)
+            report['compact_bytes'] += sum(len(member) for member in compact)
+
+        report['used_memory_after'] = self.db.info()['used_memory']
+
+        return report
+
+    # Runs the subscription scripts against the server on a throwaway user and show, checking
+    # their results and the keys they write: the scripts can only run on a real Redis server.
+    # The throwaway keys are deleted afterwards. Returns the failed checks.
+    def checkScripts(self):
+        user = showId = '__check_scripts__'
+        shard = keys.showShard(showId)
+        failures = []
+
+        def check(name, expected, actual):
+            if actual != expected:
+                failures.append('%s: expected %r, got %r' % (name, expected, actual))
+
+        # one DEL per hash slot, a cluster refuses multi-key commands across slots
+        def cleanUp():
+            self.db.delete(keys.user(user, 'shows'), keys.user(user, 'lastseen'), keys.user(user, 'version'))
+            self.db.delete(keys.show(showId), keys.show(showId, 'users'))
+            self.db.hdel(keys.showsRefcount(shard), showId)
+            self.db.hdel(keys.showsVersions(shard), showId)
+
+        cleanUp()
+
+        try:
+            check('subscribe to a new show', (0, 1), self.__subscribe(user, showId))
+            check('order at the top of an empty list', 0, self.db.zscore(keys.user(user, 'shows'), showId))
+            check('subscribe again', (0, 0), self.__subscribe(user, showId))
+            check('refcount', 1, int(self.db.hget(keys.showsRefcount(shard), showId)))
+            check('show users', set([user]), self.db.smembers(keys.show(showId, 'users')))
+
+            self.db.hset(keys.show(showId), 'name', 'Check')
+            self.db.hset(keys.user(user, 'lastseen'), showId, '00010001')
+            check('subscribe to a downloaded show', (1, 0), self.__subscribe(user, showId))
+
+            check('unsubscribe', (1, 1), self.__unsubscribe(user, showId))
+            check('user version', 1, int(self.db.get(keys.user(user, 'version'))))
+            check('last seen episode', None, self.db.hget(keys.user(user, 'lastseen'), showId))
+            check('show data', False, self.db.exists(keys.show(showId)))
+            check('refcount after unsubscription', None, self.db.hget(keys.showsRefcount(shard), showId))
+            check('show version', 1, int(self.db.hget(keys.showsVersions(shard), showId)))
+            check('unsubscribe again', (0, 0), self.__unsubscribe(user, showId))
+        finally:
+            cleanUp()
+
+        return failures
+
+    # Only the requests of update runs, which send as many as they can, are rate limited. The
+    # other ones are made while a user waits for them (searches, subscriptions, posters) and
+    # aren't delayed.
+    def __tvdbGet(self, url, **kwargs):
+        if getattr(self.rateLimited, 'active', False):
+            self.tvdbRateLimiter.acquire()
+
+        return self.http.get(url, **kwargs)
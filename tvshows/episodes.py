@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import json
+
+# Episodes are stored as members of the show:<id>:episodes sorted sets (scored by episode ID)
+# in a compact positional format: season|episode|airdate|title, where airdate is an integer
+# YYYYMMDD (0 for 0000-00-00, empty if unknown) and title is the last field so it can
+# contain the separator. Episodes stored before this format are JSON objects, which
+# decodeEpisode still reads.
+
+
+def encodeEpisode(episode):
+    airdate = episode['airdate']
+
+    if airdate is not None:
+        try:
+            year, month, day = [int(component) for component in airdate.split('-')]
+        except ValueError:
+            # not a YYYY-MM-DD date, keep the episode as is in the legacy format
+            return json.dumps(episode)
+
+        airdate = '%d' % (year * 10000 + month * 100 + day)
+
+    title = episode['title']
+    if isinstance(title, unicode):
+        title = title.encode('utf-8')
+
+    return '%d|%d|%s|%s' % (episode['season'], episode['episode'], airdate or '', title or '')
+
+
+def decodeEpisode(member):
+    if member.startswith('{'):
+        return json.loads(member)
+
+    season, episode, airdate, title = member.split('|', 3)
+    season, episode = int(season), int(episode)
+
+    if airdate:
+        airdate = int(airdate)
+        airdate = u'%04d-%02d-%02d' % (airdate // 10000, airdate // 100 % 100, airdate % 100)
+    else:
+        airdate = None
+
+    return {
+        'episode_id': u'%04d%04d' % (season, episode),
+        'title': title.decode('utf-8') if title else None,
+        'season': season,
+        'episode': episode,
+        'airdate': airdate
+    }
+
+
+def isLegacyEpisode(member):
+    return member.startswith('{')
@@ -1,21 +1,19 @@
 # -*- coding: utf-8 -*-
 from datetime import date, datetime
 from feedgen.feed import FeedGenerator
-from flask import Blueprint, render_template, request, Response, jsonify, url_for, redirect, flash, abort, send_file, current_app
+from flask import Blueprint, render_template, request, Response, jsonify, url_for, redirect, flash, abort, send_file, current_app, safe_join
 from flask.ext.babel import gettext, lazy_gettext, get_locale, refresh as refresh_locale
 from flask.ext.login import login_user, logout_user, login_required, current_user
 from flask.ext.wtf import Form, TextField, PasswordField, BooleanField, SelectField, IntegerField, validators
-from StringIO import StringIO
 
-import calendar
-from PIL import Image, ImageFile
+import mimetypes
 import os
-import requests
 import time
 import wtforms.ext.i18n.form
 
 from ..database import SeriesDatabase
-from ..helpers import logged_request
+from ..helpers import airdateKey, logged_request
+from .. import thumbnails
 from ..user import User
 
 series = SeriesDatabase()
@@ -25,60 +23,65 @@ frontend = Blueprint('frontend', __name__, template_folder='templates')
 
 # sorts episodes by date
 def unseenEpisodesKey(show):
-    return airdateKey(show['unseenEpisodes'][0]['airdate'])
+    return airdateKey(show['unseen']['airdate'])
 
 
 def upcomingEpisodesKey(show):
-    return airdateKey(show['upcomingEpisodes'][0]['airdate'])
+    return airdateKey(show['upcoming']['airdate'])
 
 def episodeAirdateKey(episodeTuple):
     _, episode = episodeTuple
     return airdateKey(episode['airdate'])
 
 
-def airdateKey(airdate):
-    year, month, day = [int(component) for component in airdate.split('-')]
+# if showId is set, only the unseen episodes of this show are loaded and returned
+def getShowsOverview(showId=None, moreMult=1):
+    shows = series.getOverview(current_user.id)
 
-    if month == 0:
-        return '%04d-12-31' % year
-
-    if day == 0:
-        return '%04d-%02d-%02d' % (year, month, calendar.monthrange(year, month)[1])
-
-    return airdate
-
-
-def getShowsOverview():
-    shows = []
-    for showId in series.getUserShowList(current_user.id):
-        show = series.getShowInfo(current_user.id, showId, withEpisodes=True, onlyUnseen=True)
-
-        if (len(show['episodes']) > 0):
-            shows.append(show)
-
-    today = date.today().strftime('%Y-%m-%d')
-    for show in shows:
-        show['unseenEpisodes'] = [episode for episode in show['episodes'] if episode['airdate'] and airdateKey(episode['airdate']) < today and episode['airdate'] != '0000-00-00']
-        show['upcomingEpisodes'] = [episode for episode in show['episodes'] if episode['airdate'] and airdateKey(episode['airdate']) >= today and episode['airdate'] != '0000-00-00']
-
-    unseen = [show for show in shows if len(show['unseenEpisodes']) > 0]
-    upcoming = [show for show in shows if len(show['upcomingEpisodes']) > 0 and (len(show['unseenEpisodes']) == 0 or (show['upcomingEpisodes'][0]['season'] == show['unseenEpisodes'][0]['season'] or (show['unseenEpisodes'][0]['episode'] > 1 and show['upcomingEpisodes'][0]['season'] <= show['unseenEpisodes'][0]['season'] + 1)))]
+    unseen = [show for show in shows if show['unseen_count'] > 0]
+    upcoming = [show for show in shows if show['upcoming'] and (show['unseen'] is None or (show['upcoming']['season'] == show['unseen']['season'] or (show['unseen']['episode'] > 1 and show['upcoming']['season'] <= show['unseen']['season'] + 1)))]
 
     unseen.sort(key=unseenEpisodesKey, reverse=True)
     upcoming.sort(key=upcomingEpisodesKey)
 
+    if showId:
+        unseen = [show for show in unseen if show['show_id'] == showId]
+
+    series.loadUnseenEpisodes(current_user.id, unseen, int(current_user.config.episodesPerShow) * moreMult)
+
     return unseen, upcoming
 
+# The feed only changes with the user's data or with the date (when episodes air), so it's
+# cached with a key made of both, which is also used as its ETag
 @frontend.route('/rss/<userID>.rss')
 @logged_request
 def latestRss(userID):
     userID = userID.lower()
+    today = date.today().strftime('%Y-%m-%d')
+
+    version, feed = series.getUserFeed(userID)
+    feedKey = '%d-%s' % (version, today)
+
+    if feed.get('key') != feedKey:
+        feed = {'key': feedKey, 'content': buildRss(userID, today), 'modified': int(time.time())}
+
+        # users without any data (or unknown user IDs) have an empty feed, don't store it
+        if version:
+            series.setUserFeed(userID, feed)
+
+    response = Response(feed['content'], mimetype='application/rss+xml')
+    response.set_etag(feedKey)
+    response.last_modified = feed['modified']
 
+    return response.make_conditional(request)
+
+
+def buildRss(userID, today):
     shows = {}
     episodes = []
-    today = date.today().strftime('%Y-%m-%d')
-    for showID in series.getUserShowList(userID):
-        shows[showID] = series.getShowInfo(userID, showID, withEpisodes=True, onlyUnseen=True)
+    for show in series.getShowInfos(userID, series.getUserShowList(userID), withEpisodes=True, onlyUnseen=True):
+        showID = show['show_id']
+        shows[showID] = show
         episodes.extend((showID, episode) for episode in shows[showID]['episodes'] if episode['airdate'] and airdateKey(episode['airdate']) < today)
 
     episodes.sort(key=episodeAirdateKey, reverse=True)
@@ -95,7 +98,7 @@ def latestRss(userID):
         entry.id('%s/%s' % (showID, episode['episode_id']))
         entry.title('%s S%02dE%02d: %s' % (shows[showID]['name'], episode['season'], episode['episode'], episode['title']))
 
-    return feed.rss_str(pretty=True)
+    return feed.rss_str()
 
 @frontend.route('/')
 @login_required
@@ -110,10 +113,7 @@ def home():
 @login_required
 @logged_request
 def shows():
-    shows = []
-    for showId in series.getUserShowList(current_user.id):
-        show = series.getShowInfo(current_user.id, showId)
-        shows.append(show)
+    shows = series.getShowInfos(current_user.id, series.getUserShowList(current_user.id), withEpisodes=False)
 
     return render_template('shows.html', shows=shows)
 
@@ -202,10 +202,7 @@ def signup():
     return render_template('signup.html', form=form)
 
 
-@frontend.route('/settings', methods=['GET', 'POST'])
-@login_required
-@logged_request
-def settings():
+def settingsForm():
     class SettingsForm(Form, wtforms.ext.i18n.form.Form):
         LANGUAGES = [get_locale().language]
 
@@ -218,7 +215,27 @@ def settings():
             validators.NumberRange(min=1)
         ])
 
-    form = SettingsForm()
+    return SettingsForm()
+
+
+def apiTokenForm():
+    class APITokenForm(Form, wtforms.ext.i18n.form.Form):
+        LANGUAGES = [get_locale().language]
+
+        name = TextField(lazy_gettext('settings.apitokens.name'), [validators.Length(min=1, max=50)])
+
+    return APITokenForm()
+
+
+def renderSettings(form, newToken=None):
+    return render_template('settings.html', form=form, tokenForm=apiTokenForm(), tokens=series.getAPITokens(current_user.id), newToken=newToken)
+
+
+@frontend.route('/settings', methods=['GET', 'POST'])
+@login_required
+@logged_request
+def settings():
+    form = settingsForm()
 
     if form.validate_on_submit():
         for field, value in form.data.items():
@@ -228,7 +245,36 @@ def settings():
 
         flash(gettext('settings.savesuccess'), 'success')
 
-    return render_template('settings.html', form=form)
+    return renderSettings(form)
+
+
+# the new token is only rendered in this response, flashing it would store it in the session cookie
+@frontend.route('/settings/tokens', methods=['POST'])
+@login_required
+@logged_request
+def create_api_token():
+    form = apiTokenForm()
+
+    if form.validate_on_submit():
+        token, _ = series.createAPIToken(current_user.id, form.name.data)
+        return renderSettings(settingsForm(), newToken=token)
+
+    flash(gettext('settings.apitokens.invalidname'), 'error')
+    return redirect(url_for('.settings'))
+
+
+@frontend.route('/settings/tokens/<tokenId>/revoke', methods=['POST'])
+@login_required
+@logged_request
+def revoke_api_token(tokenId):
+    # the form only carries the CSRF token
+    if not Form().validate_on_submit():
+        abort(400)
+
+    if series.revokeAPIToken(current_user.id, tokenId):
+        flash(gettext('settings.apitokens.revoked'), 'success')
+
+    return redirect(url_for('.settings'))
 
 
 @frontend.route("/logout")
@@ -246,12 +292,9 @@ def logout():
 def ajax_home_unseen(showId, episodeId):
     series.setLastSeen(current_user.id, showId, episodeId)
 
-    unseen, upcoming = getShowsOverview()
+    unseen, upcoming = getShowsOverview(showId=showId)
 
-    show = None
-    for s in unseen:
-        if s['show_id'] == showId:
-            show = s
+    show = unseen[0] if unseen else None
 
     return jsonify(unseen=render_template('ajax/home_unseen.html', show=show) if show else None,
                    upcoming=render_template('ajax/home_upcoming.html', upcoming=upcoming))
@@ -261,12 +304,9 @@ def ajax_home_unseen(showId, episodeId):
 @login_required
 @logged_request
 def ajax_home_show_more(showId, moreMult):
-    unseen, upcoming = getShowsOverview()
+    unseen, upcoming = getShowsOverview(showId=showId, moreMult=moreMult)
 
-    show = None
-    for s in unseen:
-        if s['show_id'] == showId:
-            show = s
+    show = unseen[0] if unseen else None
 
     return jsonify(unseen=render_template('ajax/home_unseen.html', show=show, moreMult=moreMult))
 
@@ -275,16 +315,22 @@ def ajax_home_show_more(showId, moreMult):
 @login_required
 @logged_request
 def ajax_set_show_order():
-    ordering = {}
+    if 'shows' in request.form:
+        ordering = request.form.getlist('shows')
 
-    for showId, order in request.form.iteritems():
-        if not showId.isdigit() or not order.isdigit() or not series.userHasShow(current_user.id, showId):
+        if not all(showId.isdigit() for showId in ordering):
             return Response(status=400)
+    else:
+        ordering = {}
+
+        for showId, order in request.form.iteritems():
+            if not showId.isdigit() or not order.isdigit():
+                return Response(status=400)
 
-        ordering[showId] = order
+            ordering[showId] = int(order)
 
-    for showId, order in ordering.iteritems():
-        series.addShowToUser(current_user.id, showId, order)
+    if not series.setShowsOrder(current_user.id, ordering):
+        return Response(status=400)
 
     return Response(status=204)
 
@@ -295,10 +341,7 @@ def ajax_set_show_order():
 def ajax_search_show(showName):
     results = series.searchShow(showName)
 
-    userShows = []
-    for showId in series.getUserShowList(current_user.id):
-        show = series.getShowInfo(current_user.id, showId, withEpisodes=False)
-        userShows.append(show['show_id'])
+    userShows = series.getUserShowList(current_user.id)
 
     return render_template('ajax/search_results.html', results=results, userShows=userShows)
 
@@ -308,9 +351,7 @@ def ajax_search_show(showName):
 @login_required
 @logged_request
 def ajax_posters_choice(showId):
-    show = series.getShowInfo(current_user.id, showId, withEpisodes=False)
-
-    return render_template('ajax/poster_choice.html', showId=showId, posters=series.getTVDBPosters(show))
+    return render_template('ajax/poster_choice.html', showId=showId, posters=series.getPosters(showId))
 
 
 # Sets the user's custom poster. posterPath is a relative path from RheTVDB
@@ -336,11 +377,20 @@ def set_poster(showId, posterPath=None):
 # Downloads a poster's thumbnail from TheTVDB and passes it through to the client
 # Needed because TheTVDB checks the referrer to prevent hotlinking
 # We only need it to display the lightweight thumbnails, not full-res pictures
+# Thumbnails are cached on disk and can be cached by the browser for a long time since
+# TheTVDB never changes the picture behind a given path
 @frontend.route('/remote/thumb/<path:posterPath>')
 def get_remote_thumbnail(posterPath):
-    r = requests.get(SeriesDatabase.tvdbBannerCacheURLFormat % posterPath, stream=True)
+    def fetch():
+        r = series.http.get(SeriesDatabase.tvdbBannerCacheURLFormat % posterPath)
+        return r.content if r.status_code == 200 else None
+
+    filename = thumbnails.getRemoteThumbnail(posterPath, fetch)
 
-    return Response(r.iter_content(chunk_size=512), mimetype=r.headers['content-type'])
+    if filename is None:
+        abort(404)
+
+    return send_file(filename, mimetype=mimetypes.guess_type(posterPath)[0] or 'image/jpeg', cache_timeout=thumbnails.remoteThumbsCacheTimeout, conditional=True)
 
 
 @frontend.route('/thumbs/<size>/<path:posterPath>', methods=['GET'])
@@ -353,29 +403,26 @@ def get_thumbnail(size, posterPath):
 
     width, height = [int(component) for component in splittedSize]
 
-    f = current_app.open_resource(posterPath)
-    img = Image.open(f)
+    # only the sizes used by the templates are generated, every size is cached on disk
+    if (width, height) not in thumbnails.standardSizes:
+        abort(404)
 
-    lastModified = int(os.path.getmtime(f.name))
-    
-    # caching
-    if request.if_modified_since and datetime.fromtimestamp(lastModified) <= request.if_modified_since:
-        return Response(status=304)
+    posterFile = safe_join(current_app.root_path, posterPath)
 
-    img.thumbnail((width, height), Image.ANTIALIAS)
+    if not os.path.isfile(posterFile):
+        abort(404)
 
-    thumbnail = StringIO()
+    mtime = thumbnails.posterMTime(posterFile)
+    etag = thumbnails.thumbnailETag(posterFile, width, height, mtime)
 
-    try:
-        img.save(thumbnail, 'JPEG', quality=95, optimize=True, progressive=True)
-    except IOError:
-        # http://stackoverflow.com/questions/6788398/how-to-save-progressive-jpeg-using-python-pil-1-1-7
-        ImageFile.MAXBLOCK = img.size[0] * img.size[1]
-        img.save(thumbnail, 'JPEG', quality=95, optimize=True, progressive=True)
-
-    thumbnail.seek(0)
-
-    res = send_file(thumbnail, mimetype='image/jpeg', cache_timeout=0)
-    res.last_modified = time.localtime(lastModified)
+    # caching
+    if etag in request.if_none_match or (not request.if_none_match and request.if_modified_since and datetime.fromtimestamp(mtime // 1000) <= request.if_modified_since):
+        res = Response(status=304)
+        res.set_etag(etag)
+        return res
+
+    res = send_file(thumbnails.getThumbnail(posterFile, width, height, mtime), mimetype='image/jpeg', add_etags=False, cache_timeout=0)
+    res.set_etag(etag)
+    res.last_modified = time.localtime(mtime // 1000)
 
     return res
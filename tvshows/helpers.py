@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
+import calendar
+import threading
 import time
 
 from flask import current_app, request
 from flask.ext.login import current_user
 from functools import wraps
 
+from . import metrics
+
 def retry(ExceptionToCheck, tries=4, delay=3, backoff=2, logger=None):
     """Retry calling the decorated function using an exponential backoff.
 
@@ -49,19 +53,76 @@ def retry(ExceptionToCheck, tries=4, delay=3, backoff=2, logger=None):
     return deco_retry
 
 
+class TokenBucket(object):
+    """Thread-safe token bucket used to limit the rate of outgoing requests.
+
+    :param rate: number of tokens added per second. If 0 or None, acquire never blocks
+    :param capacity: maximum number of tokens, i.e. the allowed burst (defaults to rate)
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate or 0)
+        self.capacity = float(capacity or max(self.rate, 1))
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+                self.timestamp = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+# returns a sortable date string for an airdate, replacing unknown days and months
+# with the last day of the month or year
+def airdateKey(airdate):
+    year, month, day = [int(component) for component in airdate.split('-')]
+
+    if month == 0:
+        return '%04d-12-31' % year
+
+    if day == 0:
+        return '%04d-%02d-%02d' % (year, month, calendar.monthrange(year, month)[1])
+
+    return airdate
+
+
+# Fields describing the current request in the logstash records, along with its metrics so far
+def requestLogFields():
+    fields = {
+        'method': request.method,
+        'path': request.path,
+        'ip': request.remote_addr,
+        'agent_platform': request.user_agent.platform,
+        'agent_browser': request.user_agent.browser,
+        'agent_browser_version': request.user_agent.version,
+        'agent': request.user_agent.string,
+        'user': current_user.id if not current_user.is_anonymous() else '<anonymous>'
+    }
+    fields.update(metrics.logFields())
+
+    return fields
+
+
+# Logs the request once the view has returned (or raised), so that the record includes the
+# time it took and what it was spent on
 def logged_request(func):
     @wraps(func)
     def decorated_view(*args, **kwargs):
-        current_app.logger.info('%s request on %s' % (request.method, request.path), extra={
-            'method': request.method,
-            'path': request.path,
-            'ip': request.remote_addr,
-            'agent_platform': request.user_agent.platform,
-            'agent_browser': request.user_agent.browser,
-            'agent_browser_version': request.user_agent.version,
-            'agent': request.user_agent.string,
-            'user': current_user.id if not current_user.is_anonymous() else '<anonymous>'
-        })
-
-        return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            current_app.logger.info('%s request on %s' % (request.method, request.path), extra=requestLogFields())
     return decorated_view
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+from collections import Counter
+
+import requests
+import requests.adapters
+import threading
+import urlparse
+
+from . import metrics
+
+
+class HTTPClient(object):
+    """Pooled HTTP client shared by every outgoing request of the application.
+
+    Connections are kept alive in one pool per host. When a request is made with
+    conditional=True, the ETag and Last-Modified headers of the response are stored in
+    Redis and sent back on the next request for the same URL, so an unchanged resource
+    comes back as a 304. With cacheBody=True the body is stored too, and a 304 is
+    transparently turned into the cached response. With deferValidators=True the validators
+    are only stored when storeValidators(response) is called, once the caller has saved what
+    it built from the response: if that fails, the next request downloads it again.
+
+    :param db: Redis connection used to store validators and cached bodies
+    :param timeout: timeout in seconds of every request
+    :param poolSize: maximum number of connections kept alive per host
+    """
+    bodyCacheTTL = 30 * 24 * 3600
+
+    def __init__(self, db, timeout=10, poolSize=10):
+        self.db = db
+        self.timeout = timeout
+
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+        self.counters = Counter()
+        self.countersLock = threading.Lock()
+
+    def get(self, url, conditional=False, cacheBody=False, deferValidators=False, **kwargs):
+        headers = kwargs.pop('headers', {})
+        kwargs.setdefault('timeout', self.timeout)
+
+        cacheKey = self.cacheKey(url, kwargs.get('params'))
+        cached = self.db.hgetall(cacheKey) if conditional else {}
+
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        try:
+            with metrics.timed('http'):
+                response = self.session.get(url, headers=headers, **kwargs)
+        except requests.RequestException:
+            self.count(url, 'errors')
+            raise
+
+        self.count(url, 'requests')
+
+        response.fromCache = False
+        response.cacheKey = cacheKey
+
+        if response.status_code == 304:
+            self.count(url, 'not_modified')
+
+            if cacheBody and 'content' in cached:
+                response.status_code = 200
+                response._content = cached['content']
+                response.encoding = cached.get('encoding') or None
+                response.fromCache = True
+        elif conditional and response.status_code == 200 and not deferValidators:
+            self.storeValidators(response, cacheBody)
+
+        return response
+
+    def storeValidators(self, response, cacheBody=False):
+        cacheKey = response.cacheKey
+        validators = {}
+
+        if response.headers.get('etag'):
+            validators['etag'] = response.headers['etag']
+        if response.headers.get('last-modified'):
+            validators['last_modified'] = response.headers['last-modified']
+
+        pipe = self.db.pipeline()
+        pipe.delete(cacheKey)
+
+        if validators:
+            if cacheBody:
+                validators['content'] = response.content
+                validators['encoding'] = response.encoding or ''
+
+            pipe.hmset(cacheKey, validators)
+            pipe.expire(cacheKey, HTTPClient.bodyCacheTTL)
+
+        pipe.execute()
+
+    # Returns the connection of a response requested with stream=True to its pool, which only
+    # happens by itself once the body has been read to the end. A connection whose body wasn't
+    # read to the end can't be reused as is, so it's closed and the pool reopens it.
+    def release(self, response):
+        raw = response.raw
+
+        if raw is None:
+            return
+
+        if raw._original_response is not None and not raw._original_response.isclosed() and raw._connection is not None:
+            raw._connection.close()
+
+        raw.release_conn()
+
+    # forgets the validators of a URL, e.g. when the data built from it is deleted
+    def forget(self, url, params=None):
+        self.db.delete(self.cacheKey(url, params))
+
+    def cacheKey(self, url, params=None):
+        if params:
+            url = '%s?%s' % (url, '&'.join('%s=%s' % item for item in sorted(params.items())))
+
+        return 'http:cache:%s' % url
+
+    def count(self, url, counter):
+        host = urlparse.urlparse(url).netloc
+
+        with self.countersLock:
+            self.counters[counter] += 1
+            self.counters['%s:%s' % (host, counter)] += 1
+
+    # Returns the request counters along with the number of connections opened and requests
+    # sent by the connection pools, the difference being the number of reused connections
+    def stats(self):
+        with self.countersLock:
+            stats = dict(self.counters)
+
+        connections = 0
+        requestsSent = 0
+
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requestsSent += pool.num_requests
+
+        stats['connections'] = connections
+        stats['reused_connections'] = max(0, requestsSent - connections)
+
+        if stats.get('requests'):
+            stats['not_modified_ratio'] = stats.get('not_modified', 0) / float(stats['requests'])
+
+        return stats
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from lxml import etree
+
+
+# Parses en.xml from a TheTVDB series archive (series/<id>/all/en.zip) in a single streaming
+# pass. Yields ('series', fields) for the <Series> element, then ('episode', episodeInfo) for
+# every regular episode (season 0 contains specials and is ignored). Elements are cleared once
+# they're processed so the memory used doesn't depend on the number of episodes.
+def iterShowArchive(archive):
+    for _, elem in etree.iterparse(archive.open('en.xml'), events=('end',)):
+        if elem.tag == 'Series':
+            yield 'series', elementFields(elem)
+        elif elem.tag == 'Episode':
+            episodeInfo = parseEpisode(elementFields(elem))
+
+            if episodeInfo:
+                yield 'episode', episodeInfo
+        else:
+            continue
+
+        # free the element and the already processed siblings
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def elementFields(elem):
+    return dict((child.tag, child.text) for child in elem)
+
+
+def parseEpisode(fields):
+    seasonNum = int(fields['SeasonNumber'])
+
+    if seasonNum == 0:
+        return None
+
+    episodeNum = int(fields['EpisodeNumber'])
+
+    return {
+        'episode_id': '%04d%04d' % (seasonNum, episodeNum),
+        'title': fields.get('EpisodeName'),
+        'season': seasonNum,
+        'episode': episodeNum,
+        'airdate': fields.get('FirstAired')
+    }
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import zlib
+
+# Names of the Redis keys, laid out so that the data can be spread over a Redis Cluster.
+#
+# A cluster only runs a transaction, a script or a multi-key command when all its keys are
+# in the same hash slot, which is computed from the part of the key between braces (the hash
+# tag) when there is one. So:
+#  - every key of a user is tagged with the user ID: user:{<id>}, user:{<id>}:shows...
+#  - every key of a show is tagged with the show's shard, along with the shard's hashes
+#    holding the refcount, the version and the default poster flag of its shows:
+#    show:{<shard>}:<id>, show:{<shard>}:<id>:episodes, shows:{<shard>}...
+#    This way a show is updated, subscribed to and deleted atomically along with its
+#    refcount, and the shows are listed by reading the showShards refcount hashes.
+#  - the keys of the update journal share the {update} tag.
+# Transactions and scripts only use keys of one user, one show shard or the journal.
+# Pipelines that read or write several users or shows are sent without MULTI, so that a
+# cluster client can split them by node.
+#
+# Data stored with the previous layout is rewritten by migrate() (manage.py migrate-keys).
+
+# version of the layout, stored in the layout key
+layoutVersion = 2
+layout = 'app:keylayout'
+
+# number of show shards, the shows are spread over at most this many hash slots. The shows of
+# a user are read with one command per shard, so it is kept small: enough to spread the shows
+# over the nodes of a cluster, few enough to read a library of any size with a few commands.
+# Changing it requires rewriting every show key.
+showShards = 16
+
+secretKey = 'app:secretkey'
+postersManifest = 'app:postersmanifest'
+
+updateTarget = 'app:{update}:target'
+updatePending = 'app:{update}:pending'
+updateDone = 'app:{update}:done'
+updateRetry = 'app:{update}:retry'
+lastUpdate = 'app:{update}:lastupdate'
+
+
+def showShard(showId):
+    if isinstance(showId, unicode):
+        showId = showId.encode('utf-8')
+
+    return (zlib.crc32(str(showId)) & 0xffffffff) % showShards
+
+
+# Returns the show IDs grouped by shard, as a list of (shard, showIds) tuples
+def groupByShard(showIds):
+    groups = {}
+    for showId in showIds:
+        groups.setdefault(showShard(showId), []).append(showId)
+
+    return sorted(groups.items())
+
+
+# user:{<id>} holds the password and the settings, the other keys of a user are named with
+# a suffix: shows, lastseen, overview, posters, tokens, feed, version
+def user(userId, suffix=None):
+    key = 'user:{%s}' % userId
+
+    return '%s:%s' % (key, suffix) if suffix else key
+
+
+# show:{<shard>}:<id> holds the show's fields, the other keys of a show are named with a
+# suffix: episodes, users, posters
+def show(showId, suffix=None):
+    key = 'show:{%d}:%s' % (showShard(showId), showId)
+
+    return '%s:%s' % (key, suffix) if suffix else key
+
+
+# hash of the number of users following each show of the shard
+def showsRefcount(shard):
+    return 'shows:{%d}' % shard
+
+
+# hash of the version of each show of the shard, see SeriesDatabase.__getShowData
+def showsVersions(shard):
+    return 'shows:{%d}:versions' % shard
+
+
+# hash of the shows of the shard whose default poster has been downloaded
+def showsPosters(shard):
+    return 'shows:{%d}:posters' % shard
+
+
+def apiToken(tokenId):
+    return 'apitoken:%s' % tokenId
+
+
+def search(query):
+    return 'search:%s' % query
+
+
+# Rewrites the keys of the previous layout (user:<id>..., show:<id>..., the shows, posters,
+# shows:versions, users:versions and apitokens hashes and the app:update keys) with the
+# current one. The users set and the refcount of each show are rebuilt from the users' lists,
+# so a show nobody follows anymore isn't listed by the refcount hashes. It runs on a single
+# server, before the data is moved to a cluster, and can be interrupted and run again.
+# Returns the number of users, shows and API tokens migrated and of shows nobody follows.
+def migrate(db):
+    userIds = set()
+    showIds = set()
+
+    # user:<id>[:suffix] and show:<id>[:suffix] (user IDs are alphanumeric)
+    for prefix, keyFunction, ids in (('user', user, userIds), ('show', show, showIds)):
+        for key in db.keys('%s:*' % prefix):
+            if '{' in key:
+                continue
+
+            parts = key.split(':', 2)
+            ids.add(parts[1])
+            db.rename(key, keyFunction(parts[1], parts[2] if len(parts) > 2 else None))
+
+    for userId, version in db.hgetall('users:versions').iteritems():
+        db.set(user(userId, 'version'), version)
+    db.delete('users:versions')
+
+    tokens = db.hgetall('apitokens')
+    for tokenId, userId in tokens.iteritems():
+        db.set(apiToken(tokenId), userId)
+    db.delete('apitokens')
+
+    for oldKey, keyFunction in (('shows:versions', showsVersions), ('posters', showsPosters)):
+        values = db.hgetall(oldKey)
+
+        for shard, ids in groupByShard(values.keys()):
+            db.hmset(keyFunction(shard), dict((showId, values[showId]) for showId in ids))
+
+        db.delete(oldKey)
+
+    showIds.update(db.hkeys('shows'))
+    db.delete('shows')
+
+    for oldKey, newKey in (('app:update:target', updateTarget), ('app:update:pending', updatePending),
+                           ('app:update:done', updateDone), ('app:update:retry', updateRetry), ('app:lastupdate', lastUpdate)):
+        if db.exists(oldKey):
+            db.rename(oldKey, newKey)
+
+    # the users and refcount of each show, from the users' lists
+    followers = {}
+    for userId in db.keys('user:{*}:shows'):
+        userId = userId[len('user:{'):-len('}:shows')]
+
+        for showId in db.zrange(user(userId, 'shows'), 0, -1):
+            followers.setdefault(showId, []).append(userId)
+
+    showIds.update(followers)
+
+    for shard, ids in groupByShard(showIds):
+        pipe = db.pipeline()
+        for showId in ids:
+            pipe.delete(show(showId, 'users'))
+
+            if showId in followers:
+                pipe.sadd(show(showId, 'users'), *followers[showId])
+                pipe.hset(showsRefcount(shard), showId, len(followers[showId]))
+            else:
+                pipe.hdel(showsRefcount(shard), showId)
+        pipe.execute()
+
+    db.set(layout, layoutVersion)
+
+    return {
+        'users': len(userIds),
+        'shows': len(followers),
+        'apitokens': len(tokens),
+        'unfollowed': len(showIds) - len(followers)
+    }
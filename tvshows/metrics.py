@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict
+from contextlib import contextmanager
+from jinja2 import Template
+
+import redis
+import threading
+import timeit
+
+# Per-request instrumentation: while a request is handled, its thread records the number of
+# Redis commands sent and the time spent in Redis, outgoing HTTP requests, image processing
+# and template rendering. Work done outside of a request (e.g. the update threads) isn't
+# recorded. Once the request is done, its metrics are aggregated per route and exported in
+# the Prometheus text format by /metrics.
+#
+# The aggregated metrics live in the process, so every worker process of the application
+# exports its own.
+
+# the components timed during a request, see timed()
+components = ('redis', 'http', 'image', 'template')
+
+# upper bounds in seconds of the request latency histogram buckets
+latencyBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+contentType = 'text/plain; version=0.0.4; charset=utf-8'
+
+local = threading.local()
+
+
+def startRequest():
+    local.request = {'start': timeit.default_timer(), 'status': None}
+
+
+# Returns the metrics of the request handled by the current thread, or None
+def currentRequest():
+    return getattr(local, 'request', None)
+
+
+def endRequest():
+    metrics = currentRequest()
+    local.request = None
+
+    return metrics
+
+
+def record(name, count=1, duration=None):
+    metrics = currentRequest()
+
+    if metrics is None:
+        return
+
+    metrics[name] = metrics.get(name, 0) + count
+
+    if duration is not None:
+        metrics[name + '_seconds'] = metrics.get(name + '_seconds', 0) + duration
+
+
+@contextmanager
+def timed(component, count=1):
+    start = timeit.default_timer()
+
+    try:
+        yield
+    finally:
+        record(component, count, timeit.default_timer() - start)
+
+
+# Returns the metrics of the current request as logstash fields, durations in milliseconds
+def logFields():
+    metrics = currentRequest()
+
+    if metrics is None:
+        return {}
+
+    fields = {'duration_ms': round((timeit.default_timer() - metrics['start']) * 1000, 3)}
+
+    for component in components:
+        fields['%s_count' % component] = metrics.get(component, 0)
+        fields['%s_ms' % component] = round(metrics.get(component + '_seconds', 0) * 1000, 3)
+
+    return fields
+
+
+class Histogram(object):
+    """Cumulative histogram of observed values, in the Prometheus way: every bucket counts the
+    values lower or equal to its upper bound.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+        self.count += 1
+        self.sum += value
+
+
+class Registry(object):
+    """Thread-safe aggregate of the metrics of the requests handled by the process, per route."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.requests = defaultdict(int)
+        self.componentCounts = defaultdict(int)
+        self.componentSeconds = defaultdict(float)
+        self.caches = []
+
+    def observe(self, route, method, status, metrics):
+        duration = timeit.default_timer() - metrics['start']
+
+        with self.lock:
+            if (route, method) not in self.latencies:
+                self.latencies[(route, method)] = Histogram(latencyBuckets)
+
+            self.latencies[(route, method)].observe(duration)
+            self.requests[(route, method, status)] += 1
+
+            for component in components:
+                self.componentCounts[(route, component)] += metrics.get(component, 0)
+                self.componentSeconds[(route, component)] += metrics.get(component + '_seconds', 0)
+
+    # Registers an in-process cache (see lrucache.LRUCache) whose size, hits and misses are
+    # exported. The caches registered under the same name, by several SeriesDatabase
+    # instances, are added up.
+    def registerCache(self, name, cache):
+        with self.lock:
+            self.caches.append((name, cache))
+
+    # Returns the metrics in the Prometheus text exposition format
+    def export(self):
+        lines = []
+
+        with self.lock:
+            lines.append('# HELP tvshows_request_duration_seconds Latency of the requests per route.')
+            lines.append('# TYPE tvshows_request_duration_seconds histogram')
+            for (route, method), histogram in sorted(self.latencies.items()):
+                labels = 'route="%s",method="%s"' % (escapeLabel(route), method)
+
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append('tvshows_request_duration_seconds_bucket{%s,le="%r"} %d' % (labels, float(bound), count))
+                lines.append('tvshows_request_duration_seconds_bucket{%s,le="+Inf"} %d' % (labels, histogram.count))
+                lines.append('tvshows_request_duration_seconds_sum{%s} %r' % (labels, histogram.sum))
+                lines.append('tvshows_request_duration_seconds_count{%s} %d' % (labels, histogram.count))
+
+            lines.append('# HELP tvshows_requests_total Number of requests per route and status.')
+            lines.append('# TYPE tvshows_requests_total counter')
+            for (route, method, status), count in sorted(self.requests.items()):
+                lines.append('tvshows_requests_total{route="%s",method="%s",status="%s"} %d' % (escapeLabel(route), method, status, count))
+
+            lines.append('# HELP tvshows_request_component_operations_total Number of Redis commands, HTTP requests, images processed and templates rendered per route.')
+            lines.append('# TYPE tvshows_request_component_operations_total counter')
+            for (route, component), count in sorted(self.componentCounts.items()):
+                lines.append('tvshows_request_component_operations_total{route="%s",component="%s"} %d' % (escapeLabel(route), component, count))
+
+            lines.append('# HELP tvshows_request_component_seconds_total Time spent in Redis, HTTP requests, image processing and template rendering per route.')
+            lines.append('# TYPE tvshows_request_component_seconds_total counter')
+            for (route, component), seconds in sorted(self.componentSeconds.items()):
+                lines.append('tvshows_request_component_seconds_total{route="%s",component="%s"} %r' % (escapeLabel(route), component, seconds))
+
+            cacheStats = {}
+            for name, cache in self.caches:
+                stats = cacheStats.setdefault(name, defaultdict(int))
+                for stat, value in cache.stats().items():
+                    stats[stat] += value
+
+            for stat, metricType, description in (('hits', 'counter', 'Number of lookups found in the in-process caches.'),
+                                                  ('misses', 'counter', 'Number of lookups missing from the in-process caches.'),
+                                                  ('size', 'gauge', 'Number of entries of the in-process caches.')):
+                metric = 'tvshows_cache_%s%s' % (stat, '_total' if metricType == 'counter' else '')
+                lines.append('# HELP %s %s' % (metric, description))
+                lines.append('# TYPE %s %s' % (metric, metricType))
+                for name, stats in sorted(cacheStats.items()):
+                    lines.append('%s{cache="%s"} %d' % (metric, escapeLabel(name), stats[stat]))
+
+        return '\n'.join(lines) + '\n'
+
+
+def escapeLabel(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = Registry()
+
+
+class InstrumentedConnection(redis.Connection):
+    """Redis connection recording the commands it sends, and the time spent sending them and
+    reading their replies, in the metrics of the current request. Every reply read counts as a
+    command, so a pipeline counts as many commands as it queued (plus MULTI and EXEC).
+    """
+    def send_packed_command(self, command):
+        with timed('redis', 0):
+            super(InstrumentedConnection, self).send_packed_command(command)
+
+    def read_response(self):
+        with timed('redis'):
+            return super(InstrumentedConnection, self).read_response()
+
+
+class InstrumentedUnixDomainSocketConnection(InstrumentedConnection, redis.UnixDomainSocketConnection):
+    pass
+
+
+class TimedTemplate(Template):
+    """Jinja template recording its rendering time in the metrics of the current request.
+    Included and extended templates are rendered as part of the template using them.
+    """
+    def render(self, *args, **kwargs):
+        with timed('template'):
+            return super(TimedTemplate, self).render(*args, **kwargs)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# Lua scripts run by Redis for the mutations that have to be atomic. They are registered by
+# SeriesDatabase with register_script, which loads them (SCRIPT LOAD) when the SeriesDatabase
+# is created. They're then run with EVALSHA, and loaded again if the server doesn't know them
+# anymore (e.g. after a restart). manage.py check-scripts runs them against the server.
+
+
+# The subscriptions change keys of the user and keys of the show, which are in different
+# hash slots (see keys.py), so each of them is made of two scripts: one on the user's keys
+# and one on the show's shard. The show side is run first on subscription and last on
+# unsubscription, so an interruption can leave a show with a user too many, but never a
+# user's list with a show whose data may be deleted.
+
+# Adds a user to a show's users and increments the show's refcount if they weren't there.
+#
+# KEYS: show:{<shard>}:<id>:users, shows:{<shard>}, show:{<shard>}:<id>
+# ARGV: user, show ID
+# Returns whether the show's data (show:{<shard>}:<id>) already exists, i.e. whether it
+# still has to be downloaded.
+subscribeShow = """
+if redis.call('SADD', KEYS[1], ARGV[1]) == 1 then
+    redis.call('HINCRBY', KEYS[2], ARGV[2], 1)
+end
+
+return redis.call('EXISTS', KEYS[3])
+"""
+
+# Adds a show to a user's list. Without an order, the show is put at the top of the list.
+#
+# KEYS: user:{<id>}:shows
+# ARGV: show ID, order (empty string for the top of the list)
+# Returns whether the show was added to the list.
+subscribeUser = """
+local order = ARGV[2]
+
+if order == '' then
+    local first = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    order = first[2] and tonumber(first[2]) - 1 or 0
+end
+
+return redis.call('ZADD', KEYS[1], order, ARGV[1])
+"""
+
+# Removes a show from a user's list along with the user's data for this show, and bumps the
+# user's version if the show was in the list.
+#
+# KEYS: user:{<id>}:shows, user:{<id>}:lastseen, user:{<id>}:overview, user:{<id>}:posters,
+#       user:{<id>}:version
+# ARGV: show ID
+# Returns whether the show was in the list.
+unsubscribeUser = """
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+
+redis.call('INCR', KEYS[5])
+
+return 1
+"""
+
+# Removes a user from a show's users and decrements the show's refcount if they were there.
+# When no user follows the show anymore, its data is deleted too and its version is bumped,
+# so in-process caches don't serve it anymore.
+#
+# KEYS: show:{<shard>}:<id>:users, shows:{<shard>}, shows:{<shard>}:versions,
+#       shows:{<shard>}:posters, show:{<shard>}:<id>, show:{<shard>}:<id>:episodes,
+#       show:{<shard>}:<id>:posters
+# ARGV: user, show ID
+# Returns whether the show's data was deleted, in which case its poster files have to be
+# deleted as well.
+unsubscribeShow = """
+if redis.call('SREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+
+if redis.call('HINCRBY', KEYS[2], ARGV[2], -1) > 0 then
+    return 0
+end
+
+redis.call('DEL', KEYS[1], KEYS[5], KEYS[6], KEYS[7])
+redis.call('HINCRBY', KEYS[3], ARGV[2], 1)
+redis.call('HDEL', KEYS[2], ARGV[2])
+redis.call('HDEL', KEYS[4], ARGV[2])
+
+return 1
+"""
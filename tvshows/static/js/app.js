@@ -85,13 +85,14 @@
 
   if ($('.sortable').length > 0) {
     $('.sortable').sortable().bind('sortupdate', function() {
-      var ordering = {};
-      
+      var showIds = [];
+
       $(this).find('> li[data-show-id]').each(function (index, element) {
-        ordering[$(element).data('showId')] = index;
+        showIds.push($(element).data('showId'));
       });
 
-      $.post('/ajax/showsorder', ordering);
+      // send the whole list in its new order, it's saved in a single transaction
+      $.post('/ajax/showsorder', $.param({shows: showIds}, true));
     });
   }
 
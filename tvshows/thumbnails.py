@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+from PIL import Image, ImageFile
+
+from .lrucache import SingleFlight
+from . import metrics
+
+import errno
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+
+baseDir = os.path.dirname(__file__)
+thumbsDir = os.path.join(baseDir, 'cache', 'thumbs')
+remoteThumbsDir = os.path.join(baseDir, 'cache', 'remote')
+
+# maximum size in bytes of the remote thumbnails cache
+remoteThumbsMaxSize = 100 * 1024 * 1024
+# max-age of the remote thumbnails sent to the browser
+remoteThumbsCacheTimeout = 365 * 24 * 3600
+
+remoteFlight = SingleFlight()
+
+# sizes used by the templates, the only ones served by /thumbs. They're generated as soon as
+# a poster is written.
+standardSizes = [(187, 275)]
+
+
+# Resized posters are cached on disk in a directory named after the poster path (relative
+# to the application directory), with one file per size named after the poster's mtime
+# so that a poster change never serves an outdated thumbnail
+def thumbnailDir(posterFile):
+    return os.path.join(thumbsDir, os.path.splitext(os.path.relpath(posterFile, baseDir))[0])
+
+
+def thumbnailFilename(posterFile, width, height, mtime):
+    return os.path.join(thumbnailDir(posterFile), '%dx%d-%d.jpg' % (width, height, mtime))
+
+
+def thumbnailETag(posterFile, width, height, mtime):
+    return hashlib.sha1('%s:%dx%d:%d' % (os.path.relpath(posterFile, baseDir), width, height, mtime)).hexdigest()
+
+
+def posterMTime(posterFile):
+    return int(os.path.getmtime(posterFile) * 1000)
+
+
+# Returns the filename of the thumbnail of posterFile at the given size, generating it if needed
+def getThumbnail(posterFile, width, height, mtime=None):
+    if mtime is None:
+        mtime = posterMTime(posterFile)
+
+    filename = thumbnailFilename(posterFile, width, height, mtime)
+
+    if not os.path.exists(filename):
+        generateThumbnail(posterFile, width, height, mtime)
+
+    return filename
+
+
+def generateThumbnail(posterFile, width, height, mtime):
+    with metrics.timed('image'):
+        filename = writeThumbnail(posterFile, width, height, mtime)
+
+    # remove the thumbnails of previous versions of the poster
+    for oldFilename in glob.glob(os.path.join(thumbnailDir(posterFile), '%dx%d-*.jpg' % (width, height))):
+        if oldFilename != filename:
+            try:
+                os.remove(oldFilename)
+            except OSError:
+                pass
+
+    return filename
+
+
+def writeThumbnail(posterFile, width, height, mtime):
+    img = Image.open(posterFile)
+
+    # thumbnail() lets the JPEG decoder downscale while decoding (draft mode), which is much
+    # cheaper than decoding the full image. Don't call draft() before it: a second draft()
+    # computes the scale from the already reduced size and the decoder overflows its buffer.
+    img.thumbnail((width, height), Image.ANTIALIAS)
+
+    directory = thumbnailDir(posterFile)
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    # write to a temporary file first so that concurrent requests never read a partial thumbnail
+    fd, tmpFilename = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            try:
+                img.save(f, 'JPEG', quality=95, optimize=True, progressive=True)
+            except IOError:
+                # http://stackoverflow.com/questions/6788398/how-to-save-progressive-jpeg-using-python-pil-1-1-7
+                ImageFile.MAXBLOCK = img.size[0] * img.size[1]
+                f.seek(0)
+                f.truncate()
+                img.save(f, 'JPEG', quality=95, optimize=True, progressive=True)
+
+        filename = thumbnailFilename(posterFile, width, height, mtime)
+        os.rename(tmpFilename, filename)
+    except:
+        os.remove(tmpFilename)
+        raise
+
+    return filename
+
+
+def generateStandardThumbnails(posterFile):
+    mtime = posterMTime(posterFile)
+
+    for width, height in standardSizes:
+        try:
+            getThumbnail(posterFile, width, height, mtime)
+        except IOError:
+            # not fatal, the thumbnail will be generated again on its first request
+            pass
+
+
+def deleteThumbnails(posterFile):
+    shutil.rmtree(thumbnailDir(posterFile), ignore_errors=True)
+
+
+# Remote thumbnails (TheTVDB's low resolution posters) are cached on disk in a bounded
+# directory. Their mtime is updated on every hit and the least recently used ones are
+# evicted when the directory grows over remoteThumbsMaxSize.
+def remoteThumbnailFilename(posterPath):
+    return os.path.join(remoteThumbsDir, hashlib.sha1(posterPath.encode('utf-8')).hexdigest())
+
+
+# Returns the filename of the cached remote thumbnail, calling fetch to get its content if
+# it's not cached yet (or None if fetch returns None). Concurrent calls for the same poster
+# share a single call to fetch.
+def getRemoteThumbnail(posterPath, fetch):
+    filename = remoteThumbnailFilename(posterPath)
+
+    if os.path.exists(filename):
+        try:
+            os.utime(filename, None)
+            return filename
+        except OSError:
+            # evicted in the meantime
+            pass
+
+    return remoteFlight.do(posterPath, fetchRemoteThumbnail, filename, fetch)
+
+
+def fetchRemoteThumbnail(filename, fetch):
+    # another thread may have fetched it while we were waiting
+    if os.path.exists(filename):
+        return filename
+
+    content = fetch()
+
+    if content is None:
+        return None
+
+    try:
+        os.makedirs(remoteThumbsDir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    fd, tmpFilename = tempfile.mkstemp(dir=remoteThumbsDir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(content)
+    os.rename(tmpFilename, filename)
+
+    evictRemoteThumbnails()
+
+    return filename
+
+
+def evictRemoteThumbnails():
+    files = []
+    totalSize = 0
+
+    for name in os.listdir(remoteThumbsDir):
+        if name.endswith('.tmp'):
+            continue
+
+        try:
+            stat = os.stat(os.path.join(remoteThumbsDir, name))
+        except OSError:
+            continue
+
+        files.append((stat.st_mtime, stat.st_size, name))
+        totalSize += stat.st_size
+
+    files.sort()
+
+    while files and totalSize > remoteThumbsMaxSize:
+        _, size, name = files.pop(0)
+
+        try:
+            os.remove(os.path.join(remoteThumbsDir, name))
+        except OSError:
+            pass
+
+        totalSize -= size
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 from babel import Locale
 from datetime import timedelta
-from flask import Flask, request, session
+from flask import Flask, Response, request, session
 from flask.ext.babel import Babel, lazy_gettext
 from flask.ext.login import LoginManager, current_user
 from logstash_formatter import LogstashFormatterV1
@@ -13,6 +13,8 @@ from .frontend import frontend
 from .api import api
 from .user import User
 from .database import SeriesDatabase
+from .helpers import requestLogFields
+from . import metrics
 import customfilters
 
 class LoggingFlask(Flask):
@@ -26,16 +28,12 @@ class LoggingFlask(Flask):
         self.logger.error('Exception on %s [%s]' % (
             request.path,
             request.method
-        ), exc_info=exc_info, extra={
-            'method': request.method,
-            'path': request.path,
-            'ip': request.remote_addr,
-            'agent_platform': request.user_agent.platform,
-            'agent_browser': request.user_agent.browser,
-            'agent_browser_version': request.user_agent.version,
-            'agent': request.user_agent.string,
-            'user': current_user.id if not current_user.is_anonymous() else '<anonymous>'
-        })
+        ), exc_info=exc_info, extra=requestLogFields())
+
+    def create_jinja_environment(self):
+        environment = Flask.create_jinja_environment(self)
+        environment.template_class = metrics.TimedTemplate
+        return environment
 
 app = LoggingFlask(__name__)
 
@@ -43,6 +41,39 @@ app.config['SECRET_KEY'] = SeriesDatabase().getAppSecretKey()
 
 app.debug = True if os.environ.get('DEBUG') else False
 
+# Requests metrics, see metrics.py. The metrics are started before the other before_request
+# functions, so that loading the user is measured too.
+@app.before_request
+def start_request_metrics():
+    metrics.startRequest()
+
+
+@app.after_request
+def store_response_status(response):
+    requestMetrics = metrics.currentRequest()
+    if requestMetrics is not None:
+        requestMetrics['status'] = response.status_code
+
+    return response
+
+
+@app.teardown_request
+def observe_request_metrics(exc):
+    requestMetrics = metrics.endRequest()
+
+    if requestMetrics is not None:
+        route = request.url_rule.rule if request.url_rule else '<unmatched>'
+        # no response for the requests failing with an unhandled exception
+        status = requestMetrics['status'] or 500
+
+        metrics.registry.observe(route, request.method, status, requestMetrics)
+
+
+@app.route('/metrics')
+def export_metrics():
+    return Response(metrics.registry.export(), content_type=metrics.contentType)
+
+
 app.register_blueprint(frontend)
 app.register_blueprint(api, url_prefix='/api')
 